@@ -0,0 +1,239 @@
+#!/usr/local/bin/python3
+
+'''
+    Author: zacharyrs
+
+    Latency and throughput benchmarks against the local MelView stand-in.
+
+    Run from the directory containing this component, e.g.
+        cd <config_dir>/custom_components && python -m melview.bench
+
+    License:
+                DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+                        Version 2, December 2004
+
+        Everyone is permitted to copy and distribute verbatim or modified
+        copies of this license document, and changing it is allowed as long
+        as the name is changed.
+
+                  DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+          TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+
+         0. You just DO WHAT THE FUCK YOU WANT TO.
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+from ..melview import MelView, MelViewAuthentication, DEFAULT_MAX_PARALLEL
+from ..transport import (
+    MelViewRecorder,
+    MelViewReplayTransport,
+    MelViewTransport
+)
+from .fake_server import FakeMelViewServer
+
+_LOGGER = logging.getLogger(__name__)
+
+MAX_UNITS = 500
+
+
+# ---------------------------------------------------------------
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a list of values.
+    """
+    if not values:
+        return 0.0
+
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1,
+                      int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[rank]
+
+
+def _summary(values):
+    return {'p50': percentile(values, 50), 'p90': percentile(values, 90),
+            'p99': percentile(values, 99), 'max': max(values or [0.0])}
+
+
+async def async_bench(units, args):
+    """ Run one benchmark against a fresh server with the given unit count,
+        or against recorded traffic if replaying.
+    """
+    if args.replay:
+        server = None
+        transport = MelViewReplayTransport(args.replay, args.replay_speed)
+        counter = transport
+    else:
+        server = FakeMelViewServer(units, latency=args.latency / 1000,
+                                   jitter=args.jitter / 1000,
+                                   error_rate=args.error_rate,
+                                   seed=args.seed)
+        await server.async_start()
+        transport = MelViewTransport(server.api_url, pool_size=args.pool_size)
+        counter = server
+
+    if args.record:
+        transport = MelViewRecorder(transport, args.record)
+
+    auth = MelViewAuthentication('bench@example.com', 'bench',
+                                 rate_limit=args.rate_limit,
+                                 transport=transport)
+    melview = MelView(auth, localcontrol=args.local, localstatus=args.local)
+
+    try:
+        start = time.perf_counter()
+        await auth.async_login()
+        devices = await melview.async_get_devices_list(args.max_parallel)
+        setup_s = time.perf_counter() - start
+        setup_requests = dict(counter.requests)
+
+        poll_ms = []
+        cloud_per_cycle = []
+        local_per_cycle = []
+        for _ in range(args.polls):
+            for device in devices:
+                device.set_info_lease(0) # Force a full cycle.
+            counter.reset_counts()
+
+            start = time.perf_counter()
+            await melview.async_refresh_devices(args.max_parallel)
+            poll_ms.append((time.perf_counter() - start) * 1000)
+
+            local_per_cycle.append(counter.requests['smart'])
+            cloud_per_cycle.append(sum(counter.requests.values()) -
+                                   counter.requests['smart'])
+
+        command_ms = []
+        for index in range(min(args.commands, len(devices)) if devices else 0):
+            start = time.perf_counter()
+            await devices[index].async_set_temperature(20 + index % 5)
+            command_ms.append((time.perf_counter() - start) * 1000)
+
+        # Commands issued while a full refresh is under way.
+        busy_ms = []
+        for index in range(min(args.commands, len(devices)) if devices else 0):
+            for device in devices:
+                device.set_info_lease(0)
+            refresh = asyncio.ensure_future(
+                melview.async_refresh_devices(args.max_parallel))
+            await asyncio.sleep(0)
+
+            start = time.perf_counter()
+            await devices[-1 - index].async_set_temperature(20 + index % 5)
+            busy_ms.append((time.perf_counter() - start) * 1000)
+            await refresh
+    finally:
+        await auth.async_close()
+        if server is not None:
+            await server.async_stop()
+
+    return {
+        'units': units,
+        'discovered': len(devices),
+        'setup_s': setup_s,
+        'setup_requests': setup_requests,
+        'poll_ms': _summary(poll_ms),
+        'cloud_requests_per_cycle': max(cloud_per_cycle or [0]),
+        'local_requests_per_cycle': max(local_per_cycle or [0]),
+        'command_ms': _summary(command_ms),
+        'busy_command_ms': _summary(busy_ms)
+    }
+
+
+def _print_results(results, args):
+    if args.replay:
+        print('replaying {} at {}x, local {}'.format(
+            args.replay, args.replay_speed, args.local))
+    else:
+        print('latency {}ms +/-{}ms, error rate {:.0%}, local {}'.format(
+            args.latency, args.jitter, args.error_rate, args.local))
+    print('command times include the command debounce window')
+    print('busy times are for commands sent during a full refresh')
+    print()
+    print('{:>6} {:>9} {:>9} {:>9} {:>9} {:>7} {:>7} {:>9} {:>9} {:>9} '
+          '{:>9}'.format(
+              'units', 'setup s', 'poll p50', 'poll p90', 'poll p99',
+              'cloud/c', 'lan/c', 'cmd p50', 'cmd p99', 'busy p50',
+              'busy p99'))
+    for result in results:
+        print('{:>6} {:>9.3f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7} {:>7} '
+              '{:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+                  result['units'], result['setup_s'],
+                  result['poll_ms']['p50'], result['poll_ms']['p90'],
+                  result['poll_ms']['p99'],
+                  result['cloud_requests_per_cycle'],
+                  result['local_requests_per_cycle'],
+                  result['command_ms']['p50'], result['command_ms']['p99'],
+                  result['busy_command_ms']['p50'],
+                  result['busy_command_ms']['p99']))
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(
+        prog='python -m melview.bench',
+        description='Benchmark the MelView client against a local stand-in.')
+    parser.add_argument('--units', default='1,10,50,100,500',
+                        help='comma separated unit counts (1 to {})'.format(
+                            MAX_UNITS))
+    parser.add_argument('--latency', type=float, default=50,
+                        help='cloud latency per request in ms')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='random +/- latency in ms')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of cloud requests that fail with 503')
+    parser.add_argument('--polls', type=int, default=20,
+                        help='poll cycles to time per run')
+    parser.add_argument('--commands', type=int, default=10,
+                        help='commands to time per run')
+    parser.add_argument('--local', action='store_true',
+                        help='enable local control and LAN status reads')
+    parser.add_argument('--pool-size', type=int, default=DEFAULT_MAX_PARALLEL)
+    parser.add_argument('--max-parallel', type=int,
+                        default=DEFAULT_MAX_PARALLEL)
+    parser.add_argument('--rate-limit', type=float, default=1000,
+                        help='client rate limit in requests per second')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--record', metavar='PATH',
+                        help='append the traffic to a JSON lines file')
+    parser.add_argument('--replay', metavar='PATH',
+                        help='serve recorded traffic instead of the stand-in')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='divide recorded latencies by this (0 for none)')
+    parser.add_argument('--json', metavar='PATH',
+                        help='also write the results to a JSON file')
+    parser.add_argument('--debug', action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    """ Run the benchmarks and print a summary table.
+    """
+    args = _parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+
+    counts = [int(count) for count in args.units.split(',')]
+    if any(count < 1 or count > MAX_UNITS for count in counts):
+        raise SystemExit('unit counts must be between 1 and {}'.format(
+            MAX_UNITS))
+
+    results = []
+    for count in counts:
+        results.append(asyncio.run(async_bench(count, args)))
+
+    _print_results(results, args)
+
+    if args.json:
+        with open(args.json, 'w') as handle:
+            json.dump({'args': vars(args), 'results': results}, handle,
+                      indent=2)
+
+
+if __name__ == '__main__':
+    main()
+
+# ---------------------------------------------------------------
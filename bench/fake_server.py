@@ -0,0 +1,217 @@
+#!/usr/local/bin/python3
+
+'''
+    Author: zacharyrs
+
+    Local stand-in for the MelView cloud API and the units' /smart endpoint.
+
+    License:
+                DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+                        Version 2, December 2004
+
+        Everyone is permitted to copy and distribute verbatim or modified
+        copies of this license document, and changing it is allowed as long
+        as the name is changed.
+
+                  DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+          TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+
+         0. You just DO WHAT THE FUCK YOU WANT TO.
+'''
+
+import asyncio
+import logging
+import random
+from collections import Counter
+
+from aiohttp import web
+
+_LOGGER = logging.getLogger(__name__)
+
+UNITS_PER_BUILDING = 50
+AUTH_COOKIE = 'fake-auth'
+
+LOCAL_STATUS = """<?xml version="1.0" encoding="UTF-8"?>
+<CSV>
+    <POWER>{power}</POWER>
+    <SETMODE>{setmode}</SETMODE>
+    <SETTEMP>{settemp}</SETTEMP>
+    <ROOMTEMP>{roomtemp}</ROOMTEMP>
+    <SETFAN>{setfan}</SETFAN>
+</CSV>"""
+
+
+# ---------------------------------------------------------------
+
+class FakeMelViewServer:
+    """ Serves login, rooms, unitcapabilities, unitcommand and /smart for a
+        configurable number of units, with injected latency and errors.
+        Random choices are seeded so runs are repeatable.
+    """
+    def __init__(self, units=10, latency=0.05, jitter=0.0, error_rate=0.0,
+                 local_latency=0.005, seed=0):
+        self._latency = latency
+        self._jitter = jitter
+        self._error_rate = error_rate
+        self._local_latency = local_latency
+        self._random = random.Random(seed)
+
+        self._units = {}
+        for index in range(units):
+            self._units[str(1000 + index)] = {
+                'power': index % 2, 'setmode': 3, 'settemp': '22',
+                'roomtemp': '{:.1f}'.format(20 + index % 5), 'setfan': 2,
+                'outdoortemp': '15'
+            }
+
+        self._runner = None
+        self._host = None
+        self._port = None
+        self.requests = Counter()
+
+
+    @property
+    def api_url(self):
+        """ URL template to pass to MelViewAuthentication.
+        """
+        return 'http://{}:{}/api/{{}}'.format(self._host, self._port)
+
+
+    def reset_counts(self):
+        """ Clear the per-endpoint request counters.
+        """
+        self.requests.clear()
+
+
+    async def async_start(self, host='127.0.0.1', port=0):
+        """ Start serving on the given host, on a free port by default.
+        """
+        app = web.Application()
+        app.router.add_post('/api/login.aspx', self._login)
+        app.router.add_post('/api/rooms.aspx', self._rooms)
+        app.router.add_post('/api/unitcapabilities.aspx', self._caps)
+        app.router.add_post('/api/unitcommand.aspx', self._command)
+        app.router.add_post('/units/{unitid}/smart', self._smart)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+        self._host = host
+        self._port = self._runner.addresses[0][1]
+        _LOGGER.debug('fake melview listening on %s:%d', host, self._port)
+
+
+    async def async_stop(self):
+        """ Stop serving.
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+    async def _delay(self, endpoint):
+        self.requests[endpoint] += 1
+        await asyncio.sleep(max(0, self._latency +
+                                self._random.uniform(-1, 1) * self._jitter))
+        return self._random.random() < self._error_rate
+
+
+    def _authorised(self, request):
+        return request.cookies.get('auth') == AUTH_COOKIE
+
+
+    async def _login(self, request):
+        if await self._delay('login.aspx'):
+            return web.Response(status=503)
+
+        resp = web.json_response({})
+        resp.set_cookie('auth', AUTH_COOKIE, max_age=12 * 60 * 60)
+        return resp
+
+
+    async def _rooms(self, request):
+        if await self._delay('rooms.aspx'):
+            return web.Response(status=503)
+        if not self._authorised(request):
+            return web.Response(status=401)
+
+        unitids = list(self._units)
+        buildings = []
+        for start in range(0, len(unitids), UNITS_PER_BUILDING):
+            buildings.append({
+                'buildingid': start // UNITS_PER_BUILDING,
+                'units': [{'unitid': unitid, 'room': 'Room {}'.format(unitid),
+                           'power': self._units[unitid]['power'],
+                           'mode': self._units[unitid]['setmode'],
+                           'settemp': self._units[unitid]['settemp'],
+                           'temp': self._units[unitid]['roomtemp']}
+                          for unitid in unitids[start:start +
+                                                UNITS_PER_BUILDING]]
+            })
+        return web.json_response(buildings)
+
+
+    async def _caps(self, request):
+        if await self._delay('unitcapabilities.aspx'):
+            return web.Response(status=503)
+        if not self._authorised(request):
+            return web.Response(status=401)
+
+        unitid = (await request.json())['unitid']
+        return web.json_response({
+            'halfdeg': 1, 'hasautofan': 1, 'hasautomode': 1, 'hasdrymode': 1,
+            'hasoutdoortemp': 1,
+            'max': {mode: {'min': 16, 'max': 31}
+                    for mode in ('1', '2', '3', '7', '8')},
+            'localip': '{}:{}/units/{}'.format(self._host, self._port, unitid)
+        })
+
+
+    async def _command(self, request):
+        if await self._delay('unitcommand.aspx'):
+            return web.Response(status=503)
+        if not self._authorised(request):
+            return web.Response(status=401)
+
+        payload = await request.json()
+        unit = self._units.get(str(payload['unitid']))
+        if unit is None:
+            return web.Response(status=404)
+
+        reply = dict(unit)
+        if 'commands' in payload:
+            for command in payload['commands'].split(','):
+                self._apply(unit, command)
+            reply = dict(unit, lc='{}:{}'.format(payload['unitid'],
+                                                 payload['commands']))
+        return web.json_response(reply)
+
+
+    async def _smart(self, request):
+        self.requests['smart'] += 1
+        await asyncio.sleep(self._local_latency)
+
+        unit = self._units.get(request.match_info['unitid'])
+        if unit is None:
+            return web.Response(status=404)
+
+        body = await request.text()
+        if '<CODE>' in body:
+            return web.Response(text='<CSV><RESULT>OK</RESULT></CSV>')
+        return web.Response(text=LOCAL_STATUS.format(**unit))
+
+
+    @staticmethod
+    def _apply(unit, command):
+        keys = {'PW': 'power', 'MD': 'setmode', 'TS': 'settemp',
+                'FS': 'setfan'}
+        if command[:2] not in keys:
+            return
+        value = float(command[2:])
+        if command[:2] == 'TS':
+            unit['settemp'] = '{:g}'.format(value)
+        else:
+            unit[keys[command[:2]]] = int(value)
+
+# ---------------------------------------------------------------
@@ -0,0 +1,98 @@
+#!/usr/local/bin/python3
+
+'''
+    Author: zacharyrs
+
+    How to install:
+        Refer to README.md
+
+    License:
+                DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+                        Version 2, December 2004
+
+        Everyone is permitted to copy and distribute verbatim or modified
+        copies of this license document, and changing it is allowed as long
+        as the name is changed.
+
+                  DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+          TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+
+         0. You just DO WHAT THE FUCK YOU WANT TO.
+'''
+
+import logging
+
+from homeassistant.components.binary_sensor import (
+    DEVICE_CLASS_POWER,
+    BinarySensorEntity
+)
+
+from .const import DOMAIN
+from .entity import MelViewDeviceEntity
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------
+
+class MelViewPowerSensor(MelViewDeviceEntity, BinarySensorEntity):
+    """ Power state of a unit, updated by the same refresh as the climate
+        entity.
+    """
+    def __init__(self, coordinator, device):
+        super().__init__(coordinator, device, ['power'])
+
+        self._unique_id = '{}_power'.format(device.get_id())
+
+
+    @property
+    def name(self):
+        """ Diplay name for HASS
+        """
+        return 'MelView {} Power'.format(self._device.get_friendly_name())
+
+
+    @property
+    def unique_id(self):
+        """ Get unique_id for HASS
+        """
+        return self._unique_id
+
+
+    @property
+    def device_class(self):
+        """ Report as a power sensor
+        """
+        return DEVICE_CLASS_POWER
+
+
+    @property
+    def is_on(self):
+        """ Check unit is on
+        """
+        return self._device.get_state().power
+
+# ---------------------------------------------------------------
+
+async def async_setup_platform(hass, config, async_add_entities,
+                               discovery_info=None):
+    """ Set up the power sensors for a melview account set up by the
+        climate platform.
+    """
+    if discovery_info is None:
+        return
+
+    data = hass.data[DOMAIN][discovery_info['account']]
+
+    def _add_devices(devices):
+        entities = []
+        for device in devices:
+            entity = MelViewPowerSensor(data['coordinator'], device)
+            data['entities'].setdefault(device.get_id(), []).append(entity)
+            entities.append(entity)
+        async_add_entities(entities)
+
+    data['platforms']['binary_sensor'] = _add_devices
+    _add_devices(data['melview'].get_devices())
+
+# ---------------------------------------------------------------
@@ -20,7 +20,11 @@
          0. You just DO WHAT THE FUCK YOU WANT TO.
 '''
 
+import asyncio
 import logging
+from functools import partial
+
+import voluptuous as vol
 
 from homeassistant.components.climate.const import (
     HVAC_MODE_OFF,
@@ -36,87 +40,163 @@ from homeassistant.components.climate.const import (
     SUPPORT_FAN_MODE,
     SUPPORT_TARGET_TEMPERATURE
 )
-from homeassistant.components.climate import ClimateEntity
+from homeassistant.components.climate import PLATFORM_SCHEMA, ClimateEntity
 from homeassistant.const import (
     ATTR_TEMPERATURE,
+    CONF_SCAN_INTERVAL,
+    EVENT_HOMEASSISTANT_STOP,
     PRECISION_HALVES,
     PRECISION_WHOLE,
     STATE_OFF,
     TEMP_CELSIUS
 )
-
-from .melview import MelViewAuthentication, MelView, MODE, FAN
+from homeassistant.core import callback
+from homeassistant.exceptions import PlatformNotReady
+import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers import entity_registry
+from homeassistant.helpers.discovery import async_load_platform
+from homeassistant.helpers.event import async_call_later
+
+from .const import DOMAIN
+from .entity import MelViewDeviceEntity
+from .coordinator import (
+    MelViewCoordinator,
+    DEFAULT_POLL_BUDGET,
+    DEFAULT_SCAN_INTERVAL,
+    DEFAULT_UPDATE_TIMEOUT
+)
+from .stats import DEFAULT_WINDOW, FILTER_MEAN, FILTERS
+from .storage import (
+    MelViewCapsCache,
+    MelViewCommandCache,
+    MelViewCookieStore,
+    MelViewDeviceRegistry
+)
+from .melview import (
+    MelViewAuthentication,
+    MelView,
+    MODE,
+    FAN,
+    DEFAULT_MAX_PARALLEL
+)
+from .throttle import DEFAULT_RATE
+from .transport import (
+    CLOUD_CONNECT_SECONDS,
+    CLOUD_READ_SECONDS,
+    DEFAULT_POOL_SIZE,
+    LOCAL_CONNECT_SECONDS,
+    LOCAL_READ_SECONDS,
+    MelViewRecorder,
+    MelViewTransport,
+    request_timeout
+)
 
 _LOGGER = logging.getLogger(__name__)
 
-DOMAIN = 'melview'
-REQUIREMENTS = ['requests']
+REQUIREMENTS = []
 DEPENDENCIES = []
 
-HVAC_MODES = [HVAC_MODE_AUTO, HVAC_MODE_COOL, HVAC_MODE_DRY, HVAC_MODE_FAN_ONLY, HVAC_MODE_HEAT, HVAC_MODE_OFF]
+ACCOUNT_RETRY_SECONDS = 60
+
+SERVICE_APPLY = 'apply'
+EVENT_APPLY_RESULT = 'melview_apply_result'
+
+_SECONDS = vol.All(vol.Coerce(float), vol.Range(min=0.1))
+
+# Options of one account, also accepted at the platform level as defaults
+# for every account. Their defaults are applied once the two are merged.
+ACCOUNT_OPTIONS = {
+    vol.Optional('email'): cv.string,
+    vol.Optional('password'): cv.string,
+    vol.Optional('local'): cv.boolean,
+    vol.Optional('local_status'): cv.boolean,
+    vol.Optional('metrics'): cv.boolean,
+    vol.Optional('sensors'): cv.boolean,
+    vol.Optional('prefetch_commands'): cv.boolean,
+    vol.Optional('pool_size'): cv.positive_int,
+    vol.Optional('rate_limit'): vol.All(vol.Coerce(float),
+                                        vol.Range(min=0.01)),
+    vol.Optional('max_parallel'): cv.positive_int,
+    vol.Optional('poll_budget'): cv.positive_int,
+    vol.Optional('update_timeout'): _SECONDS,
+    vol.Optional('cloud_connect_timeout'): _SECONDS,
+    vol.Optional('cloud_read_timeout'): _SECONDS,
+    vol.Optional('local_connect_timeout'): _SECONDS,
+    vol.Optional('local_read_timeout'): _SECONDS,
+    vol.Optional('temp_window'): cv.positive_int,
+    vol.Optional('temp_filter'): vol.In(FILTERS),
+    vol.Optional('temp_outlier_delta'): vol.All(vol.Coerce(float),
+                                                vol.Range(min=0)),
+    vol.Optional('buildings'): vol.All(cv.ensure_list, [cv.string]),
+    vol.Optional('units'): vol.All(cv.ensure_list, [cv.string]),
+    vol.Optional('record_traffic'): cv.string
+}
+
+ACCOUNT_SCHEMA = vol.Schema(ACCOUNT_OPTIONS).extend({
+    vol.Optional(CONF_SCAN_INTERVAL): cv.time_period
+})
+
+PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(ACCOUNT_OPTIONS).extend({
+    vol.Optional('accounts'): vol.All(cv.ensure_list, [ACCOUNT_SCHEMA])
+})
+
+def _has_selector(value):
+    """ Changing every unit has to be asked for explicitly.
+    """
+    if not (value.get('unitids') or value.get('buildings')
+            or value['all']):
+        raise vol.Invalid('give unitids or buildings, or all: true')
 
+    return value
 
-# ---------------------------------------------------------------
 
-class MelViewClimate(ClimateEntity):
-    """ Melview handler for HomeAssistants
+def _has_change(value):
+    """ A call must change something on the units.
     """
-    def __init__(self, device):
-        self._device = device
+    if not any(key in value for key in ('power', 'hvac_mode',
+                                        ATTR_TEMPERATURE, 'fan_mode')):
+        raise vol.Invalid('give power, hvac_mode, temperature or fan_mode')
 
-        self._name = 'MelView {}'.format(device.get_friendly_name())
-        self._unique_id = device.get_id()
+    return value
 
-        self._operations_list = [x for x in MODE] + [HVAC_MODE_OFF]
-        self._speeds_list = [x for x in FAN]
 
-        self._precision = PRECISION_WHOLE
-        self._target_step = 1.0
-        if self._device.get_precision_halves():
-            self._precision = PRECISION_HALVES
-            self._target_step = 0.5
+SERVICE_APPLY_SCHEMA = vol.All(vol.Schema({
+    vol.Optional('unitids'): vol.All(cv.ensure_list, [cv.string]),
+    vol.Optional('buildings'): vol.All(cv.ensure_list, [cv.string]),
+    vol.Optional('all', default=False): cv.boolean,
+    vol.Optional('power'): cv.boolean,
+    vol.Optional('hvac_mode'): vol.In(list(MODE) + [HVAC_MODE_OFF]),
+    vol.Optional(ATTR_TEMPERATURE): vol.Coerce(float),
+    vol.Optional('fan_mode'): vol.In(list(FAN))
+}), _has_selector, _has_change)
 
-        self._current_temp = self._device.get_room_temperature()
-        self._target_temp = self._device.get_temperature()
-
-        self._mode = self._device.get_mode()
-        self._speed = self._device.get_speed()
-
-        self._state = STATE_OFF
-        if self._device.is_power_on():
-            self._state = self._mode
+# Snapshot fields shown by the climate entity.
+CLIMATE_FIELDS = ('power', 'mode', 'speed', 'target_temperature',
+                  'room_temperature', 'precision_halves',
+                  'room_temperature_stats')
 
+HVAC_MODES = [HVAC_MODE_AUTO, HVAC_MODE_COOL, HVAC_MODE_DRY, HVAC_MODE_FAN_ONLY, HVAC_MODE_HEAT, HVAC_MODE_OFF]
 
-    def update(self):
-        """ Update device properties
-        """
-        _LOGGER.debug('updating state')
-        self._device.force_update()
 
-        self._precision = PRECISION_WHOLE
-        self._target_step = 1.0
-        if self._device.get_precision_halves():
-            self._precision = PRECISION_HALVES
-            self._target_step = 0.5
+# ---------------------------------------------------------------
 
-        self._current_temp = self._device.get_room_temperature()
-        self._target_temp = self._device.get_temperature()
+class MelViewClimate(MelViewDeviceEntity, ClimateEntity):
+    """ Melview handler for HomeAssistants
+    """
+    def __init__(self, coordinator, device):
+        super().__init__(coordinator, device, CLIMATE_FIELDS)
 
-        self._mode = self._device.get_mode()
-        self._speed = self._device.get_speed()
+        self._unique_id = device.get_id()
 
-        self._state = self._mode
-        
-        if not self._device.is_power_on():
-            self._mode = 'off'
-            self._state = STATE_OFF
+        self._operations_list = [x for x in MODE] + [HVAC_MODE_OFF]
+        self._speeds_list = [x for x in FAN]
 
 
     @property
     def name(self):
         """ Diplay name for HASS
         """
-        return self._name
+        return 'MelView {}'.format(self._device.get_friendly_name())
 
 
     @property
@@ -127,39 +207,47 @@ class MelViewClimate(ClimateEntity):
 
 
     @property
-    def supported_features(self):
-        """ Let HASS know feature support
-            TODO: Handle looking at the device features?
+    def extra_state_attributes(self):
+        """ Expose the recent room temperature statistics
         """
-        return (SUPPORT_TARGET_TEMPERATURE | SUPPORT_FAN_MODE)
+        return {'room_temperature_{}'.format(key): val for key, val
+                in self._device.get_room_temperature_stats().items()}
 
 
     @property
-    def should_poll(self):
-        """ Ensure HASS polls the unit
+    def supported_features(self):
+        """ Let HASS know feature support
+            TODO: Handle looking at the device features?
         """
-        return True
+        return (SUPPORT_TARGET_TEMPERATURE | SUPPORT_FAN_MODE)
 
 
     @property
     def state(self):
         """ Return the current state.
         """
-        return self._state
+        state = self._device.get_state()
+        if not state.power:
+            return STATE_OFF
+
+        return state.mode
 
 
     @property
     def is_on(self):
         """ Check unit is on
         """
-        return self._state != STATE_OFF
+        return self._device.get_state().power
 
 
     @property
     def precision(self):
         """ Return the precision of the system.
         """
-        return self._precision
+        if self._device.get_state().precision_halves:
+            return PRECISION_HALVES
+
+        return PRECISION_WHOLE
 
 
     @property
@@ -173,14 +261,14 @@ class MelViewClimate(ClimateEntity):
     def current_temperature(self):
         """ Get the current room temperature
         """
-        return self._current_temp
+        return self._device.get_state().room_temperature
 
 
     @property
     def target_temperature(self):
         """ Get the target temperature
         """
-        return self._target_temp
+        return self._device.get_state().target_temperature
 
 
     # TODO
@@ -204,14 +292,17 @@ class MelViewClimate(ClimateEntity):
     def target_temperature_step(self):
         """ Return the supported step of target temperature
         """
-        return self._target_step
+        if self._device.get_state().precision_halves:
+            return 0.5
+
+        return 1.0
 
 
     @property
     def hvac_mode(self):
         """ Get the current operating mode
         """
-        return self._mode
+        return self._device.get_state().mode
 
 
     @property
@@ -225,7 +316,7 @@ class MelViewClimate(ClimateEntity):
     def fan_mode(self):
         """ Check the unit fan speed
         """
-        return self._speed
+        return self._device.get_state().speed
 
 
     @property
@@ -235,92 +326,327 @@ class MelViewClimate(ClimateEntity):
         return self._speeds_list
 
 
-    def set_temperature(self, **kwargs):
+    async def async_set_temperature(self, **kwargs):
         """ Set the target temperature
         """
         temp = kwargs.get(ATTR_TEMPERATURE)
         if temp is not None:
             _LOGGER.debug('setting temp %d', temp)
-            if self._device.set_temperature(temp):
-                self._current_temp = temp
+            await self._device.async_set_temperature(temp)
 
 
-    def set_fan_mode(self, speed):
+    async def async_set_fan_mode(self, speed):
         """ Set the fan speed
         """
         _LOGGER.debug('set fan mode: %s', speed)
-        if self._device.set_speed(speed):
-            self._speed = speed
-            self._mode = self._device.get_mode()
-            self._state = self._mode
+        await self._device.async_set_speed(speed)
 
 
-    def set_hvac_mode(self, mode):
+    async def async_set_hvac_mode(self, mode):
         """ Set the operation mode
         """
         _LOGGER.debug('set mode: %s', mode)
         if mode == 'off':
-            self.turn_off()
-        elif self._device.set_mode(mode):
-            self._mode = mode
-            self._state = mode
+            await self.async_turn_off()
+        else:
+            await self._device.async_set_mode(mode)
 
 
-    def turn_on(self):
+    async def async_turn_on(self):
         """ Turn on the unit
         """
         _LOGGER.debug('power on')
-        if self._device.power_on():
-            self._mode = self._device.get_mode()
-            self._state = self._mode
+        await self._device.async_power_on()
 
 
-    def turn_off(self):
+    async def async_turn_off(self):
         """ Turn off the unit
         """
         _LOGGER.debug('power off')
-        if self._device.power_off():
-            self._mode = 'off'
-            self._state = STATE_OFF
+        await self._device.async_power_off()
 
 # ---------------------------------------------------------------
 
-def setup_platform(hass, config, add_devices, discovery_info=None):
-    """ Set up the HASS component
+async def _async_handle_apply(hass, call):
+    """ Apply one change to many units across all accounts, and fire an
+        event with the result for each unit.
     """
-    _LOGGER.debug('adding component')
+    changes = {
+        'power': call.data.get('power'),
+        'mode': call.data.get('hvac_mode'),
+        'temperature': call.data.get(ATTR_TEMPERATURE),
+        'speed': call.data.get('fan_mode')
+    }
+
+    if call.data['all']:
+        unitids = buildings = None # Every unit.
+    else:
+        unitids = call.data.get('unitids', [])
+        buildings = call.data.get('buildings', [])
+
+    accounts = hass.data.get(DOMAIN, {})
+    reports = await asyncio.gather(*[
+        data['melview'].async_apply(unitids, buildings,
+                                    data['max_parallel'], **changes)
+        for data in accounts.values()], return_exceptions=True)
+
+    report = {}
+    errors = {}
+    for email, account_report in zip(accounts, reports):
+        if isinstance(account_report, Exception):
+            _LOGGER.error('melview apply failed for %s: %r', email,
+                          account_report)
+            errors[email] = repr(account_report)
+            continue
+        for unitid, result in account_report.items():
+            if isinstance(result, Exception):
+                errors[unitid] = repr(result)
+                result = False
+            report[unitid] = result
+
+    failed = [unitid for unitid, result in report.items() if not result]
+    if failed:
+        _LOGGER.error('melview apply failed for units %s', failed)
+    hass.bus.async_fire(EVENT_APPLY_RESULT, {
+        'results': report,
+        'errors': errors,
+        'succeeded': len(report) - len(failed),
+        'failed': len(failed)
+    })
+
+
+async def _async_reconcile_devices(hass, data):
+    """ Bring the restored units of an account in line with rooms.aspx,
+        adding and removing their entities.
+    """
+    result = await data['melview'].async_reconcile_devices()
+    if result is None:
+        _LOGGER.warning('unable to reconcile melview units, '
+                        'keeping the stored list')
+        return False
 
+    added, removed = result
+    if added:
+        _LOGGER.info('adding %d new melview units', len(added))
+        for add_devices in data['platforms'].values():
+            add_devices(added)
+
+    registry = entity_registry.async_get(hass)
+    for device in removed:
+        _LOGGER.info('removing melview unit %s', device.get_friendly_name())
+        for entity in data['entities'].pop(device.get_id(), []):
+            if entity.registry_entry is not None:
+                registry.async_remove(entity.entity_id)
+            else:
+                await entity.async_remove()
+
+    return True
+
+
+async def _async_setup_account(hass, config, stores, async_add_entities):
+    """ Set up the units of one melview account, with its own session,
+        rate limit and coordinator. Returns None if the unit list could
+        not be fetched, so setup can be retried.
+    """
     email = config.get('email')
     password = config.get('password')
     local = config.get('local')
+    local_status = config.get('local_status', False)
+    metrics = config.get('metrics', False)
+    sensors = config.get('sensors', False)
+    prefetch_commands = config.get('prefetch_commands', False)
+    pool_size = config.get('pool_size', DEFAULT_POOL_SIZE)
+    rate_limit = config.get('rate_limit', DEFAULT_RATE)
+    max_parallel = config.get('max_parallel', DEFAULT_MAX_PARALLEL)
+    poll_budget = config.get('poll_budget', DEFAULT_POLL_BUDGET)
+    update_timeout = config.get('update_timeout', DEFAULT_UPDATE_TIMEOUT)
+    cloud_timeout = request_timeout(
+        config.get('cloud_connect_timeout', CLOUD_CONNECT_SECONDS),
+        config.get('cloud_read_timeout', CLOUD_READ_SECONDS))
+    local_timeout = request_timeout(
+        config.get('local_connect_timeout', LOCAL_CONNECT_SECONDS),
+        config.get('local_read_timeout', LOCAL_READ_SECONDS))
+    smoothing = {
+        'window': config.get('temp_window', DEFAULT_WINDOW),
+        'method': config.get('temp_filter', FILTER_MEAN),
+        'outlier_delta': config.get('temp_outlier_delta')
+    }
+    buildings = config.get('buildings')
+    units = config.get('units')
+    record_path = config.get('record_traffic')
 
     if email is None:
         _LOGGER.error('no email provided')
         return False
 
     if password is None:
-        _LOGGER.error('no password provided')
+        _LOGGER.error('no password provided for %s', email)
         return False
 
     if local is None:
         _LOGGER.warning('local unspecified, defaulting to false')
         local = False
 
-    mv_auth = MelViewAuthentication(email, password)
-    if not mv_auth.login():
-        _LOGGER.error('login combination')
-        return False
+    if local and local_status:
+        _LOGGER.warning('local_status is experimental, falling back to the '
+                        'cloud when a unit reply cannot be read')
+
+    transport = MelViewTransport(pool_size=pool_size,
+                                 cloud_timeout=cloud_timeout,
+                                 local_timeout=local_timeout)
+    if record_path is not None:
+        _LOGGER.warning('recording melview traffic for %s to %s', email,
+                        record_path)
+        transport = MelViewRecorder(transport, record_path)
+
+    mv_auth = MelViewAuthentication(email, password,
+                                    cookie_store=stores['cookies'],
+                                    rate_limit=rate_limit,
+                                    transport=transport)
+
+    melview = MelView(mv_auth, localcontrol=local, caps_cache=stores['caps'],
+                      localstatus=local_status, smoothing=smoothing,
+                      command_cache=stores['commands'] if local else None,
+                      buildings=buildings, units=units)
+
+    # Start from the units saved last run if there are any, so startup does
+    # not wait on the cloud; they are reconciled in the background.
+    restored = stores['devices'].get(email)
+    logged_in = mv_auth.restore_login()
+    if restored is not None:
+        devices = melview.restore_devices(restored)
+    else:
+        if not logged_in and not await mv_auth.async_login():
+            _LOGGER.error('login combination for %s', email)
+            await mv_auth.async_close()
+            return False
+
+        devices = await melview.async_discover_devices()
+        if devices is None:
+            await mv_auth.async_close()
+            return None
+
+    async def _async_close_session(event):
+        stores['devices'].set(email, melview.get_registry(), force=True)
+        await mv_auth.async_close()
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, _async_close_session)
+
+    coordinator = MelViewCoordinator(
+        hass, melview, config.get(CONF_SCAN_INTERVAL, DEFAULT_SCAN_INTERVAL),
+        max_parallel, poll_budget, update_timeout)
+
+    data = hass.data.setdefault(DOMAIN, {})[email] = {
+        'melview': melview,
+        'coordinator': coordinator,
+        'max_parallel': max_parallel,
+        'entities': {}, # unitid -> entities of every platform
+        'platforms': {} # platform -> callback adding entities for devices
+    }
+
+    def _add_devices(new_devices):
+        entities = []
+        for device in new_devices:
+            entity = MelViewClimate(coordinator, device)
+            data['entities'].setdefault(device.get_id(), []).append(entity)
+            entities.append(entity)
+        async_add_entities(entities)
+
+    data['platforms']['climate'] = _add_devices
+
+    # Entities stay unavailable until the first refresh reaches their unit,
+    # unless restored with their last settings.
+    _LOGGER.debug('found %d devices for %s', len(devices), email)
+    _add_devices(devices)
+
+    @callback
+    def _save_devices():
+        stores['devices'].set(email, melview.get_registry())
+
+    coordinator.async_add_listener(_save_devices)
+
+    async def _async_first_refresh():
+        if restored is not None and \
+                await _async_reconcile_devices(hass, data):
+            stores['devices'].set(email, melview.get_registry(), force=True)
+        await coordinator.async_refresh()
+        await melview.async_revalidate_caps(max_parallel)
+        if local and prefetch_commands:
+            await melview.async_prefetch_local_commands(max_parallel)
+
+    hass.async_create_task(_async_first_refresh())
+    # Companion entities read the same snapshots, so add no requests.
+    discovery = {'account': email, 'metrics': metrics, 'sensors': sensors}
+    if metrics or sensors:
+        hass.async_create_task(async_load_platform(
+            hass, 'sensor', DOMAIN, discovery, config))
+    if sensors:
+        hass.async_create_task(async_load_platform(
+            hass, 'binary_sensor', DOMAIN, discovery, config))
+
+    return True
 
-    melview = MelView(mv_auth, localcontrol=local)
 
-    device_list = []
+async def async_setup_platform(hass, config, async_add_entities,
+                               discovery_info=None):
+    """ Set up the HASS component
+        Each entry under accounts is set up separately, taking any option
+        it does not set from the platform config.
+    """
+    _LOGGER.debug('adding component')
 
-    devices = melview.get_devices_list()
-    for device in devices:
-        _LOGGER.debug('new device: %s', device.get_friendly_name())
-        device_list.append(MelViewClimate(device))
+    shared = {key: val for key, val in config.items() if key != 'accounts'}
+    accounts = [dict(shared, **account)
+                for account in config.get('accounts', [{}])]
+
+    stores = {
+        'cookies': MelViewCookieStore(hass),
+        'caps': MelViewCapsCache(hass),
+        'commands': MelViewCommandCache(hass),
+        'devices': MelViewDeviceRegistry(hass)
+    }
+    for store in stores.values():
+        await store.async_load()
+
+    async def _async_setup_accounts(batch):
+        setup = await asyncio.gather(*[
+            _async_setup_account(hass, account, stores, async_add_entities)
+            for account in batch], return_exceptions=True)
+        for index, (account, result) in enumerate(zip(batch, setup)):
+            # One broken account must not take the others down with it.
+            if isinstance(result, Exception):
+                _LOGGER.error('unable to set up melview account %s: %r',
+                              account.get('email'), result)
+                setup[index] = False
+        return setup
+
+    results = await _async_setup_accounts(accounts)
+    pending = [account for account, result in zip(accounts, results)
+               if result is None]
+    if pending and len(pending) == len(accounts):
+        raise PlatformNotReady('unable to fetch the melview unit list')
+
+    async def _async_retry(now):
+        retried = await _async_setup_accounts(pending)
+        pending[:] = [account for account, result in zip(pending, retried)
+                      if result is None]
+        if pending:
+            async_call_later(hass, ACCOUNT_RETRY_SECONDS, _async_retry)
+
+    if pending:
+        _LOGGER.error('unable to fetch the unit list for %s, retrying',
+                      ', '.join(account.get('email') for account in pending))
+        async_call_later(hass, ACCOUNT_RETRY_SECONDS, _async_retry)
+
+    # Accounts still pending get their entities later, and need the
+    # service then.
+    if not pending and not any(results):
+        return False
 
-    add_devices(device_list)
+    if not hass.services.has_service(DOMAIN, SERVICE_APPLY):
+        hass.services.async_register(DOMAIN, SERVICE_APPLY,
+                                     partial(_async_handle_apply, hass),
+                                     schema=SERVICE_APPLY_SCHEMA)
 
     _LOGGER.debug('component successfully added')
     return True
@@ -0,0 +1,3 @@
+"""Constants for the MelView integration."""
+
+DOMAIN = 'melview'
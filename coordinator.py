@@ -0,0 +1,182 @@
+#!/usr/local/bin/python3
+
+'''
+    Author: zacharyrs
+
+    How to install:
+        Refer to README.md
+
+    License:
+                DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+                        Version 2, December 2004
+
+        Everyone is permitted to copy and distribute verbatim or modified
+        copies of this license document, and changing it is allowed as long
+        as the name is changed.
+
+                  DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+          TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+
+         0. You just DO WHAT THE FUCK YOU WANT TO.
+'''
+
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from homeassistant.helpers.update_coordinator import (
+    DataUpdateCoordinator,
+    UpdateFailed
+)
+
+from .melview import DEFAULT_MAX_PARALLEL
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_SCAN_INTERVAL = timedelta(seconds=10) # Shortest unit interval.
+DEFAULT_POLL_BUDGET = 60 # Cloud requests per minute, per account.
+DEFAULT_UPDATE_TIMEOUT = 30 # Deadline for one refresh cycle, in seconds.
+
+FAST_POLL_SECONDS = 10
+CONVERGING_POLL_SECONDS = 30
+STABLE_POLL_SECONDS = 120
+OFF_POLL_SECONDS = 300
+
+COMMAND_SETTLE_SECONDS = 120 # Poll fast for this long after a command.
+CONVERGED_DELTA = 1.0 # Room within this many degrees of the set temp.
+
+BUDGET_SCALE_STEP = 1.25
+BUDGET_MAX_POLL_SECONDS = 900 # Never slowed down past this.
+
+
+# ---------------------------------------------------------------
+
+class MelViewPollScheduler:
+    """ Sets each unit's info lease from its activity.
+        Units polled through the cloud are slowed down together when the
+        estimated cloud requests would exceed the per-minute budget.
+    """
+    def __init__(self, budget=DEFAULT_POLL_BUDGET):
+        self._budget = budget
+        self._over_budget = False
+
+
+    def get_interval(self, device):
+        """ Pick the refresh interval for one unit.
+        """
+        if (time.time() - device.get_command_time()) < COMMAND_SETTLE_SECONDS:
+            return FAST_POLL_SECONDS
+
+        state = device.get_state()
+        if not state.power:
+            return OFF_POLL_SECONDS
+
+        if state.room_temperature is None or state.target_temperature is None:
+            return CONVERGING_POLL_SECONDS
+
+        delta = state.room_temperature - state.target_temperature
+        if abs(delta) > CONVERGED_DELTA:
+            return CONVERGING_POLL_SECONDS
+
+        return STABLE_POLL_SECONDS
+
+
+    @staticmethod
+    def estimate_rate(intervals):
+        """ Estimate the cloud requests per minute for the given unit
+            intervals: one rooms.aspx call per cycle of the fastest unit
+            polled through the cloud, which renews all of them, plus a
+            unitcommand.aspx call per unit whenever its full lease (for the
+            fields rooms.aspx lacks) has run out by its next refresh.
+            Units with local status renew both leases over the LAN.
+        """
+        cloud = {device: interval for device, interval in intervals.items()
+                 if not device.has_local_status()}
+        rate = 60 / min(cloud.values()) if cloud else 0
+        for device, interval in cloud.items():
+            rate += 60 / max(interval, device.get_full_lease())
+        return rate
+
+
+    def apply(self, devices):
+        """ Update the info lease of every unit.
+        """
+        intervals = {device: self.get_interval(device) for device in devices}
+
+        scale = 1
+        scaled = intervals
+        rate = self.estimate_rate(scaled)
+        while rate > self._budget:
+            scale *= BUDGET_SCALE_STEP
+            slowed = {device: interval if device.has_local_status()
+                      else min(interval * scale,
+                               max(interval, BUDGET_MAX_POLL_SECONDS))
+                      for device, interval in intervals.items()}
+            if slowed == scaled:
+                break
+            scaled = slowed
+            rate = self.estimate_rate(scaled)
+        if scale > 1:
+            _LOGGER.debug('cloud requests over budget, slowing by %.1fx '
+                          'to %.1f/min', scale, rate)
+
+        over_budget = rate > self._budget
+        if over_budget and not self._over_budget:
+            _LOGGER.warning('%d units need about %.0f cloud requests/min, '
+                            'over the poll budget of %d', len(intervals),
+                            rate, self._budget)
+        self._over_budget = over_budget
+
+        for device, interval in scaled.items():
+            device.set_info_lease(interval)
+
+# ---------------------------------------------------------------
+
+class MelViewCoordinator(DataUpdateCoordinator):
+    """ Refreshes the due units of one melview account in a single cycle.
+    """
+    def __init__(self, hass, melview, update_interval=DEFAULT_SCAN_INTERVAL,
+                 max_parallel=DEFAULT_MAX_PARALLEL,
+                 poll_budget=DEFAULT_POLL_BUDGET,
+                 update_timeout=DEFAULT_UPDATE_TIMEOUT):
+        super().__init__(hass, _LOGGER, name='melview',
+                         update_interval=update_interval)
+        self._melview = melview
+        self._max_parallel = max_parallel
+        self._scheduler = MelViewPollScheduler(poll_budget)
+        self._update_timeout = update_timeout
+
+        # Refresh units due before the next cycle in this one.
+        self._lease_slack = update_interval.total_seconds() / 2
+
+
+    async def _async_update_data(self):
+        """ Fetch the latest state for the units that are due.
+        """
+        self._scheduler.apply(self._melview.get_devices())
+
+        start = time.monotonic()
+        try:
+            success = await asyncio.wait_for(
+                self._melview.async_refresh_devices(self._max_parallel,
+                                                    self._lease_slack),
+                self._update_timeout)
+        except asyncio.TimeoutError:
+            # Units not refreshed in time keep their expired lease, so they
+            # are picked up again next cycle.
+            _LOGGER.warning('melview refresh cancelled after %.1fs',
+                            time.monotonic() - start)
+            success = False
+
+        # Units whose refresh failed are marked unavailable on their own, so
+        # the whole account only fails when no unit due could be refreshed.
+        if not success:
+            if self._melview.is_cloud_available() or not self.last_update_success:
+                raise UpdateFailed('unable to refresh melview units')
+            # Keep serving the last known state while the cloud is paused.
+            _LOGGER.debug('melview api paused, keeping last known state')
+
+        return True
+
+# ---------------------------------------------------------------
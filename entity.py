@@ -0,0 +1,88 @@
+#!/usr/local/bin/python3
+
+'''
+    Author: zacharyrs
+
+    How to install:
+        Refer to README.md
+
+    License:
+                DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+                        Version 2, December 2004
+
+        Everyone is permitted to copy and distribute verbatim or modified
+        copies of this license document, and changing it is allowed as long
+        as the name is changed.
+
+                  DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+          TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+
+         0. You just DO WHAT THE FUCK YOU WANT TO.
+'''
+
+import logging
+
+from homeassistant.core import callback
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
+
+_LOGGER = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------
+
+class MelViewDeviceEntity(CoordinatorEntity):
+    """ Base for entities showing part of a unit's snapshot.
+        State is only written when one of the given snapshot fields or the
+        availability changes, not on every coordinator refresh.
+    """
+    def __init__(self, coordinator, device, fields):
+        super().__init__(coordinator)
+        self._device = device
+        # Every entity is named after the unit.
+        self._fields = set(fields) | {'name'}
+        self._written_available = None
+
+
+    async def async_added_to_hass(self):
+        """ Listen for snapshot changes as well as coordinator refreshes
+        """
+        await super().async_added_to_hass()
+        self.async_on_remove(
+            self._device.add_listener(self._handle_device_change))
+
+
+    @property
+    def available(self):
+        """ Unavailable until the unit has been refreshed once, and while
+            its refreshes fail
+        """
+        return super().available and self._device.is_ready() and \
+            not self._device.has_update_failed()
+
+
+    @callback
+    def _handle_coordinator_update(self):
+        """ Only a change of availability needs writing after a refresh
+        """
+        if self.available != self._written_available:
+            self.async_write_ha_state()
+
+
+    @callback
+    def _handle_device_change(self, changed):
+        """ Write state if any field shown by this entity changed
+        """
+        if self._fields.intersection(changed) or \
+                self.available != self._written_available:
+            _LOGGER.debug('%s changed: %s', self.entity_id, changed)
+            self.async_write_ha_state()
+
+
+    @callback
+    def async_write_ha_state(self):
+        """ Remember the availability written along with the state
+        """
+        self._written_available = self.available
+        super().async_write_ha_state()
+
+# ---------------------------------------------------------------
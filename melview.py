@@ -20,9 +20,34 @@
          0. You just DO WHAT THE FUCK YOU WANT TO.
 '''
 
+import asyncio
 import logging
 import time
-import requests
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+
+from .metrics import MelViewMetrics
+from .stats import RollingStat
+from .throttle import (
+    DEFAULT_RATE,
+    PRIORITY_BACKGROUND,
+    PRIORITY_COMMAND,
+    PRIORITY_POLL,
+    CircuitBreaker,
+    RequestScheduler,
+    TokenBucket,
+    backoff_delay
+)
+from .transport import (
+    API_URL,
+    DEFAULT_POOL_SIZE,
+    CloudReply,
+    LocalReply,
+    MelViewTransport
+)
 
 from homeassistant.components.climate.const import (
     HVAC_MODE_OFF,
@@ -43,8 +68,12 @@ _LOGGER = logging.getLogger(__name__)
 
 APPVERSION = '5.3.1330'
 APIVERSION = 3
-HEADERS = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) ' \
-    'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.131 Safari/537.36'}
+MAX_RETRIES = 2
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+COOKIE_LIFETIME_SECONDS = 12 * 60 * 60 # Used if the cookie has no expiry.
+COOKIE_REFRESH_SECONDS = 60 * 60 # Log in again this long before expiry.
+DEFAULT_MAX_PARALLEL = DEFAULT_POOL_SIZE
+COMMAND_DEBOUNCE_SECONDS = 0.3
 
 LOCAL_DATA = """<?xml version="1.0" encoding="UTF-8"?>
 <CSV>
@@ -54,6 +83,12 @@ LOCAL_DATA = """<?xml version="1.0" encoding="UTF-8"?>
     </CODE>
 </CSV>"""
 
+LOCAL_STATUS_DATA = """<?xml version="1.0" encoding="UTF-8"?>
+<CSV>
+    <CONNECT>ON</CONNECT>
+</CSV>"""
+
+
 
 # ---------------------------------------------------------------
 
@@ -72,15 +107,171 @@ FAN = {
     FAN_HIGH: 5
 }
 
+MODE_NAMES = {val: key for key, val in MODE.items()}
+FAN_NAMES = {val: key for key, val in FAN.items()}
+
+# /smart status tags -> unitcommand.aspx keys and types.
+LOCAL_FIELDS = {
+    'POWER': ('power', int),
+    'SETMODE': ('setmode', int),
+    'SETTEMP': ('settemp', float),
+    'ROOMTEMP': ('roomtemp', float),
+    'OUTDOORTEMP': ('outdoortemp', float),
+    'SETFAN': ('setfan', int)
+}
+
+# Keys needed before the info can be used on its own.
+FULL_FIELDS = ('power', 'setmode', 'settemp', 'setfan')
+
+# Command prefixes -> unitcommand.aspx keys and types.
+COMMAND_FIELDS = {
+    'PW': ('power', int),
+    'MD': ('setmode', int),
+    'TS': ('settemp', float),
+    'FS': ('setfan', lambda value: int(float(value)))
+}
+
+# rooms.aspx unit keys -> unitcommand.aspx keys and types.
+ROOM_FIELDS = {
+    'power': ('power', int),
+    'mode': ('setmode', int),
+    'settemp': ('settemp', float),
+    'temp': ('roomtemp', float)
+}
+
+# ---------------------------------------------------------------
+
+def _stat_summary(stat):
+    if stat.value is None:
+        return {}
+
+    return {'min': round(stat.minimum, 1), 'max': round(stat.maximum, 1),
+            'trend': round(stat.trend, 2)}
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _id_set(idents):
+    if idents is None:
+        return None
+
+    return {str(ident) for ident in idents}
+
+
+def _cookie_expiry(morsel):
+    now = time.time()
+    try:
+        if morsel['max-age']:
+            return now + int(morsel['max-age'])
+        if morsel['expires']:
+            return parsedate_to_datetime(morsel['expires']).timestamp()
+    except (TypeError, ValueError):
+        _LOGGER.debug('unable to parse cookie expiry: %s', morsel)
+
+    return now + COOKIE_LIFETIME_SECONDS
+
+
+def parse_local_status(text):
+    """ Parse a /smart status reply into unitcommand.aspx style info.
+        The plain XML format assumed here is unconfirmed on real units.
+    """
+    try:
+        root = ET.fromstring(text)
+    except ET.ParseError:
+        _LOGGER.debug('unable to parse local status: %s', text)
+        return {}
+
+    info = {}
+    for element in root.iter():
+        if element.tag.upper() not in LOCAL_FIELDS:
+            continue
+        info_key, cast = LOCAL_FIELDS[element.tag.upper()]
+        try:
+            info[info_key] = cast(element.text.strip())
+        except (AttributeError, TypeError, ValueError):
+            continue
+
+    return info
+
+# ---------------------------------------------------------------
+
+class MelViewState(namedtuple('MelViewState', [
+        'power', 'setmode', 'mode', 'speed', 'target_temperature',
+        'room_temperature', 'outside_temperature', 'precision_halves'])):
+    """ Decoded unit settings, rebuilt once per refresh.
+        Unknown values are None, and mode is HVAC_MODE_OFF while off.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_info(cls, info, caps, rtemp, otemp):
+        """ Decode unitcommand.aspx style info with the unit caps and
+            smoothed temperatures.
+        """
+        caps = caps or {}
+        if info is None:
+            return cls(False, None, None, None, None, None, None,
+                       caps.get('halfdeg') == 1)
+
+        power = bool(info.get('power'))
+        setmode = _to_int(info.get('setmode'))
+        mode = MODE_NAMES.get(setmode) if power else HVAC_MODE_OFF
+
+        outside = None
+        if caps.get('hasoutdoortemp', 0) != 0 and otemp.value is not None:
+            outside = round(otemp.value, 1)
+
+        return cls(
+            power=power,
+            setmode=setmode,
+            mode=mode,
+            speed=FAN_NAMES.get(_to_int(info.get('setfan'))),
+            target_temperature=_to_float(info.get('settemp')),
+            room_temperature=None if rtemp.value is None \
+                else round(rtemp.value, 1),
+            outside_temperature=outside,
+            precision_halves=caps.get('halfdeg') == 1
+        )
+
 # ---------------------------------------------------------------
 
 class MelViewAuthentication:
     """ Implementation to remember and refresh melview cookies.
     """
-    def __init__(self, email, password):
+    def __init__(self, email, password, session=None,
+                 pool_size=DEFAULT_POOL_SIZE, cookie_store=None,
+                 rate_limit=DEFAULT_RATE, api_url=API_URL,
+                 cloud_timeout=None, local_timeout=None, transport=None):
         self._email = email
         self._password = password
         self._cookie = None
+        self._cookie_expires = 0
+        self._cookie_store = cookie_store
+        self._generation = 0
+        self._login_result = None
+
+        self._transport = transport or MelViewTransport(
+            api_url, session, pool_size, cloud_timeout, local_timeout)
+        self._loop = None
+        self._requests = set()
+        self._closed = False
+
+        self._limiter = TokenBucket(rate_limit)
+        self._scheduler = RequestScheduler(pool_size, self._limiter)
+        self._breaker = CircuitBreaker()
+        self._metrics = MelViewMetrics()
 
 
     def is_login(self):
@@ -89,29 +280,278 @@ class MelViewAuthentication:
         return self._cookie is not None
 
 
-    def login(self):
+    def get_metrics(self):
+        """ Return the request metrics for this account.
+        """
+        return self._metrics
+
+
+    def get_generation(self):
+        """ Return a counter that changes with every new login cookie.
+        """
+        return self._generation
+
+
+    def get_transport(self):
+        """ Return the transport sending this account's requests.
+        """
+        return self._transport
+
+
+    def run_blocking(self, coro):
+        """ Run a coroutine to completion from synchronous code.
+            Must not be called from within the event loop.
+        """
+        if self._loop is not None and self._loop.is_running():
+            return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(coro)
+
+
+    def restore_login(self):
+        """ Reuse a stored login cookie, if it has not expired.
+            Must be called from within the event loop.
+        """
+        if self._cookie_store is None:
+            return False
+
+        stored = self._cookie_store.get(self._email)
+        if stored is None or stored['expires'] <= time.time():
+            return False
+
+        _LOGGER.debug('reusing stored login cookie')
+        self._cookie = stored['cookie']
+        self._cookie_expires = stored['expires']
+        self._generation += 1
+        self._loop = asyncio.get_running_loop()
+        self._transport.set_cookie('auth', self._cookie)
+        return True
+
+
+    async def async_login(self):
         """ Generate a new login cookie.
+            Concurrent callers share the result of a single login.
         """
-        _LOGGER.debug('trying to login')
+        if self._login_result is not None:
+            return await asyncio.shield(self._login_result)
 
-        self._cookie = None
-        req = requests.post('https://api.melview.net/api/login.aspx',
-                            json={'user': self._email, 'pass': self._password,
-                                  'appversion': APPVERSION},
-                            headers=HEADERS)
+        result = asyncio.get_running_loop().create_future()
+        self._login_result = result
+        success = False
+        try:
+            success = await self._async_login()
+        finally:
+            self._login_result = None
+            result.set_result(success)
+
+        return success
+
+
+    async def async_relogin(self, generation):
+        """ Log in again after a 401, unless the cookie used for the failed
+            request (given by its generation) has already been replaced.
+        """
+        if generation != self._generation and self._login_result is None:
+            return self.is_login()
+
+        if await self.async_login():
+            return True
+        if generation == self._generation:
+            # The cookie was refused, so it is no use until a login works.
+            self._cookie = None
+            self._transport.clear_cookies()
+        return False
+
+
+    async def async_refresh_login(self):
+        """ Log in again if the cookie is missing or close to expiring.
+        """
+        if not self.is_login():
+            return await self.async_login()
+
+        if (self._cookie_expires - time.time()) > COOKIE_REFRESH_SECONDS:
+            return True
+
+        _LOGGER.debug('login cookie expiring, refreshing')
+        if await self.async_login():
+            return True
+
+        # Keep using the old cookie until it expires.
+        return self.is_login() and self._cookie_expires > time.time()
 
-        if req.status_code == 200:
-            cks = req.cookies
+
+    async def _async_login(self):
+        _LOGGER.debug('trying to login')
+        self._metrics.record_login()
+
+        # The old cookie and jar are kept until a new cookie arrives, so a
+        # failed refresh leaves a working login in place.
+        reply = await self.async_post('login.aspx',
+                                      {'user': self._email,
+                                       'pass': self._password,
+                                       'appversion': APPVERSION},
+                                      PRIORITY_COMMAND)
+        if reply.status == 200:
+            cks = reply.cookies
             if 'auth' in cks:
-                self._cookie = cks['auth']
+                self._cookie = cks['auth'].value
+                self._cookie_expires = _cookie_expiry(cks['auth'])
+                self._generation += 1
+                self._transport.set_cookie('auth', self._cookie)
+                if self._cookie_store is not None:
+                    self._cookie_store.set(self._email, self._cookie,
+                                           self._cookie_expires)
                 return True
             _LOGGER.error('missing auth cookie -> cookies: %s', cks)
-        else:
-            _LOGGER.error('login status code: %d', req.status_code)
+        elif reply.status is not None:
+            _LOGGER.error('login status code: %d', reply.status)
 
         return False
 
 
+    async def async_post(self, endpoint, payload, priority=PRIORITY_POLL,
+                         key=None):
+        """ POST to a cloud API endpoint, within the account rate limit.
+            Requests are queued by priority; a queued poll is dropped when
+            a command with the same key (the unit id) is queued.
+            Connection errors and server errors are retried with jittered
+            backoff. Returns a CloudReply, with a status of None if no
+            usable reply was received, the circuit is open or the request
+            was dropped.
+        """
+        if self._closed:
+            return CloudReply(None, None, {})
+
+        if not self._breaker.allow():
+            _LOGGER.debug('circuit open, skipping %s', endpoint)
+            return CloudReply(None, None, {})
+
+        trial = self._breaker.has_trial()
+        try:
+            return await self._async_post(endpoint, payload, priority, key)
+        finally:
+            # A trial dropped or cancelled before its result came back
+            # must not hold the circuit half-open.
+            if trial:
+                self._breaker.record_abandoned()
+
+
+    async def _async_post(self, endpoint, payload, priority, key):
+        for attempt in range(MAX_RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(backoff_delay(attempt - 1))
+
+            if not await self._scheduler.async_acquire(priority, key):
+                return CloudReply(None, None, {})
+            start = time.monotonic()
+            try:
+                reply = await self._async_track(
+                    self._transport.async_post(endpoint, payload))
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    ValueError) as err:
+                _LOGGER.debug('%s request failed: %r', endpoint, err)
+                self._metrics.record_request(endpoint, None,
+                                             time.monotonic() - start)
+                continue
+            except asyncio.CancelledError:
+                if not self._closed:
+                    raise
+                _LOGGER.debug('%s request cancelled on close', endpoint)
+                return CloudReply(None, None, {})
+            finally:
+                self._scheduler.release()
+
+            self._metrics.record_request(endpoint, reply.status,
+                                         time.monotonic() - start)
+
+            if reply.status not in RETRY_STATUSES:
+                self._breaker.record_success()
+                return reply
+            _LOGGER.debug('%s request failed (status code: %d)',
+                          endpoint, reply.status)
+
+        self._breaker.record_failure()
+        _LOGGER.error('no usable reply from %s after %d attempts',
+                      endpoint, MAX_RETRIES + 1)
+        return CloudReply(None, None, {})
+
+
+    async def async_post_local(self, host, data, priority=PRIORITY_POLL,
+                               key=None):
+        """ POST to a unit's /smart endpoint over the LAN. These share the
+            connection slots with cloud requests, but not the rate limit.
+            Returns a LocalReply, with a status of None if no reply was
+            received in time or the request was dropped.
+        """
+        if self._closed:
+            return LocalReply(None, None)
+
+        if not await self._scheduler.async_acquire(priority, key,
+                                                   limited=False):
+            return LocalReply(None, None)
+        start = time.monotonic()
+        try:
+            reply = await self._async_track(
+                self._transport.async_post_local(host, data))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            _LOGGER.debug('local request to %s failed: %r', host, err)
+            self._metrics.record_request('smart', None,
+                                         time.monotonic() - start)
+            return LocalReply(None, None)
+        except asyncio.CancelledError:
+            if not self._closed:
+                raise
+            return LocalReply(None, None)
+        finally:
+            self._scheduler.release()
+
+        self._metrics.record_request('smart', reply.status,
+                                     time.monotonic() - start)
+        return reply
+
+
+    async def _async_track(self, coro):
+        """ Run a request as its own task, so it can be cancelled on close.
+        """
+        self._loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(coro)
+        self._requests.add(task)
+        try:
+            return await task
+        finally:
+            self._requests.discard(task)
+
+
+    def is_cloud_available(self):
+        """ Check the cloud API is not being paused after failures.
+        """
+        return not self._breaker.is_open()
+
+
+    def login(self):
+        """ Generate a new login cookie (blocking).
+        """
+        return self.run_blocking(self.async_login())
+
+
+    async def async_close(self):
+        """ Cancel in-flight requests and close the transport.
+            Later requests fail without being sent.
+        """
+        self._closed = True
+        self._scheduler.close()
+        if self._requests:
+            _LOGGER.debug('cancelling %d in-flight requests',
+                          len(self._requests))
+            for task in self._requests:
+                task.cancel()
+            await asyncio.gather(*self._requests, return_exceptions=True)
+
+        await self._transport.async_close()
+
+
     def get_cookie(self):
         """ Return authentication cookie.
         """
@@ -124,140 +564,627 @@ class MelViewDevice:
     """
 
     def __init__(self, deviceid, buildingid, friendlyname,
-                 authentication, localcontrol=False):
+                 authentication, localcontrol=False, caps_cache=None,
+                 localstatus=False, smoothing=None, command_cache=None):
         self._deviceid = deviceid
         self._buildingid = buildingid
         self._friendlyname = friendlyname
         self._authentication = authentication
 
         self._caps = None
-        self._localip = localcontrol
+        self._caps_cache = caps_cache
+        self._localcontrol = localcontrol
+        self._localstatus = localcontrol and localstatus
+        self._localip = None
+        self._command_cache = command_cache
+        self._local_commands = {}
 
         self._info_lease_seconds = 30 # Data lasts for 30s.
+        self._full_lease_seconds = 300 # Non-room fields last for 5m.
+        self._last_info_time_s = 0
+        self._last_full_time_s = 0
+        self._last_command_time_s = 0
+        self._update_failed = False
         self._json = None
-        self._rtemp_list = []
-        self._otemp_list = []
+        self._rtemp = RollingStat(**(smoothing or {}))
+        self._otemp = RollingStat(**(smoothing or {}))
+        self._state = MelViewState.from_info(None, None, self._rtemp,
+                                             self._otemp)
+        self._stats = {}
+        self._listeners = []
 
-        self._refresh_device_caps()
-        self._refresh_device_info()
+        self._command_debounce_seconds = COMMAND_DEBOUNCE_SECONDS
+        self._pending_commands = {}
+        self._pending_result = None
+        self._sending_commands = {}
+        self._sending_result = None
 
 
     def __str__(self):
         return str(self._json)
 
 
-    def _refresh_device_caps(self, retry=True):
-        self._json = None
-        self._last_info_time_s = time.time()
+    async def async_setup(self):
+        """ Fetch the unit capabilities and current settings.
+            Stored capabilities are used as-is when available.
+        """
+        await self.async_setup_caps()
+        await self._async_refresh_device_info()
+
+
+    async def async_setup_caps(self):
+        """ Load the unit capabilities, from storage if available.
+        """
+        if self._caps is None and self._caps_cache is not None:
+            caps = self._caps_cache.get(self._deviceid)
+            if caps is not None:
+                self._set_caps(caps)
+
+        if self._command_cache is not None and not self._local_commands:
+            self._local_commands = dict(self._command_cache.get(
+                self._deviceid))
 
-        req = requests.post('https://api.melview.net/api/unitcapabilities.aspx',
-                            cookies=self._authentication.get_cookie(),
-                            json={'unitid': self._deviceid, 'v': APIVERSION})
-        if req.status_code == 200:
-            self._caps = req.json()
-            if self._localip and 'localip' in self._caps:
-                self._localip = self._caps['localip']
+        return await self._async_is_caps_valid()
+
+
+    def restore(self, info):
+        """ Use stored caps and previously saved settings until the first
+            refresh, without any request. The settings are treated as
+            expired, so the first refresh replaces them.
+        """
+        if self._caps_cache is not None:
+            caps = self._caps_cache.get(self._deviceid)
+            if caps is not None:
+                self._set_caps(caps)
+
+        if info:
+            self._set_info(dict(info))
+            self._last_info_time_s = 0
+            self._last_full_time_s = 0
+
+
+    def has_caps(self):
+        """ Check the unit capabilities have been loaded.
+        """
+        return self._caps is not None
+
+
+    def is_ready(self):
+        """ Check both capabilities and settings have been loaded.
+        """
+        return self._caps is not None and self._json is not None
+
+
+    def has_update_failed(self):
+        """ Check the last refresh of the unit failed.
+        """
+        return self._update_failed
+
+
+    def set_update_failed(self, failed):
+        """ Record whether the last refresh of the unit failed.
+        """
+        self._update_failed = failed
+
+
+    def _set_caps(self, caps):
+        self._caps = caps
+        if self._localcontrol and 'localip' in self._caps:
+            self._localip = self._caps['localip']
+        self._update_state()
+
+
+    def _set_info(self, info):
+        self._json = info
+        if 'roomtemp' in info:
+            self._rtemp.add(info['roomtemp'])
+        if 'outdoortemp' in info:
+            self._otemp.add(info['outdoortemp'])
+        self._update_state()
+
+
+    def _update_state(self):
+        previous, previous_stats = self._state, self._stats
+        self._state = MelViewState.from_info(self._json, self._caps,
+                                             self._rtemp, self._otemp)
+        self._stats = {
+            'room_temperature_stats': _stat_summary(self._rtemp),
+            'outside_temperature_stats': _stat_summary(self._otemp)
+        }
+
+        changed = [field for field, old, new
+                   in zip(MelViewState._fields, previous, self._state)
+                   if old != new]
+        changed.extend(name for name, summary in self._stats.items()
+                       if previous_stats.get(name) != summary)
+        self._notify_listeners(changed)
+
+
+    def _notify_listeners(self, changed):
+        if changed:
+            for listener in list(self._listeners):
+                listener(changed)
+
+
+    def add_listener(self, update_callback):
+        """ Call update_callback with the names of the changed fields
+            whenever a refresh or command changes the state snapshot, the
+            temperature stats (room_temperature_stats and
+            outside_temperature_stats) or the name.
+            Returns a function removing the listener.
+        """
+        self._listeners.append(update_callback)
+
+        def _remove_listener():
+            self._listeners.remove(update_callback)
+
+        return _remove_listener
+
+
+    def needs_caps_revalidation(self):
+        """ Check whether the stored capabilities have passed their TTL.
+        """
+        if self._caps is None:
+            return True
+
+        if self._caps_cache is None:
+            return False
+
+        return not self._caps_cache.is_fresh(self._deviceid)
+
+
+    async def async_revalidate_caps(self):
+        """ Refresh the capabilities, keeping the current ones on failure.
+        """
+        return await self._async_refresh_device_caps()
+
+
+    async def _async_refresh_device_caps(self, retry=True):
+        generation = self._authentication.get_generation()
+        reply = await self._authentication.async_post(
+            'unitcapabilities.aspx', {'unitid': self._deviceid, 'v': APIVERSION})
+        if reply.status == 200:
+            self._set_caps(reply.json)
+            if self._caps_cache is not None:
+                self._caps_cache.set(self._deviceid, self._caps)
             return True
-        if req.status_code == 401 and retry:
+
+        if reply.status == 401 and retry:
             _LOGGER.error('caps error 401 (trying to re-login)')
-            if self._authentication.login():
-                return self._refresh_device_caps(retry=False)
-        else:
+            if await self._authentication.async_relogin(generation):
+                return await self._async_refresh_device_caps(retry=False)
+        elif reply.status is not None:
             _LOGGER.error('unable to retrieve caps ' \
-                '(invalid status code: %d)', req.status_code)
+                '(invalid status code: %d)', reply.status)
         return False
 
 
-    def _refresh_device_info(self, retry=True):
-        self._json = None
+    def set_info_lease(self, seconds):
+        """ Set how long fetched info stays current.
+        """
+        self._info_lease_seconds = seconds
+
+
+    def get_info_lease(self):
+        """ Get how long fetched info stays current.
+        """
+        return self._info_lease_seconds
+
+
+    def get_full_lease(self):
+        """ Get how long the fields missing from rooms.aspx stay current.
+        """
+        return self._full_lease_seconds
+
+
+    def is_info_stale(self, slack=0):
+        """ Check whether the info lease has expired (or will within slack).
+        """
+        if self._json is None:
+            return True
+
+        age = time.time() - self._last_info_time_s
+        return age + slack >= self._info_lease_seconds
+
+
+    def get_command_time(self):
+        """ Get when the last command was sent.
+        """
+        return self._last_command_time_s
+
+
+    def has_local_status(self):
+        """ Check the unit can be read directly over the LAN.
+        """
+        return self._localstatus and self._localip is not None
+
+
+    async def async_refresh_local_info(self, priority=PRIORITY_POLL):
+        """ Refresh info from the unit itself over the LAN.
+        """
+        reply = await self._authentication.async_post_local(
+            self._localip, LOCAL_STATUS_DATA, priority,
+            self._get_poll_key(priority))
+        if reply.status is None and self._is_superseded(priority):
+            return await self._async_command_result()
+        if reply.status != 200:
+            if reply.status is not None:
+                _LOGGER.debug('local status failed (status code: %d)',
+                              reply.status)
+            return False
+        status = parse_local_status(reply.text)
+
+        full = all(key in status for key in FULL_FIELDS)
+        if not status or (self._json is None and not full):
+            _LOGGER.debug('local status incomplete: %s', reply.text)
+            return False
+
+        self._set_info(dict(self._json or {}, **status))
         self._last_info_time_s = time.time()
+        if full:
+            self._last_full_time_s = self._last_info_time_s
+        return True
+
 
-        req = requests.post('https://api.melview.net/api/unitcommand.aspx',
-                            cookies=self._authentication.get_cookie(),
-                            json={'unitid': self._deviceid, 'v': APIVERSION})
-        if req.status_code == 200:
-            self._json = req.json()
-            if 'roomtemp' in self._json:
-                self._rtemp_list.append(float(self._json['roomtemp']))
-                # Keep only last 10 temperature values.
-                self._rtemp_list = self._rtemp_list[-10:]
-            if 'outdoortemp' in self._json:
-                self._otemp_list.append(float(self._json['outdoortemp']))
-                # Keep only last 10 temperature values.
-                self._otemp_list = self._otemp_list[-10:]
+    async def _async_refresh_device_info(self, retry=True,
+                                         priority=PRIORITY_POLL):
+        if retry and self.has_local_status():
+            if (await self.async_refresh_local_info(priority)
+                    and not self.needs_full_update()):
+                return True
+            _LOGGER.debug('falling back to cloud for info')
+
+        generation = self._authentication.get_generation()
+        reply = await self._authentication.async_post(
+            'unitcommand.aspx', {'unitid': self._deviceid, 'v': APIVERSION},
+            priority, self._get_poll_key(priority))
+        if reply.status is None and self._is_superseded(priority):
+            return await self._async_command_result()
+        if reply.status == 200:
+            self._set_info(reply.json)
+            self._last_info_time_s = time.time()
+            self._last_full_time_s = self._last_info_time_s
             return True
-        if req.status_code == 401 and retry:
+
+        # Keep serving the last known info until a refresh succeeds.
+        if reply.status == 401 and retry:
             _LOGGER.error('info error 401 (trying to re-login)')
-            if self._authentication.login():
-                return self._refresh_device_info(retry=False)
-        else:
+            if await self._authentication.async_relogin(generation):
+                return await self._async_refresh_device_info(False,
+                                                             priority)
+        elif reply.status is not None:
             _LOGGER.error('unable to retrieve info (invalid status code: %d)',
-                          req.status_code)
+                          reply.status)
         return False
 
 
-    def _is_info_valid(self):
+    def _get_poll_key(self, priority):
+        # Reads made for a command must not drop anything themselves.
+        if priority == PRIORITY_COMMAND:
+            return None
+
+        return self._deviceid
+
+
+    def _is_superseded(self, priority):
+        return priority != PRIORITY_COMMAND and \
+            self._sending_result is not None
+
+
+    async def _async_command_result(self):
+        """ Wait for the command being sent, in place of a poll that was
+            dropped (or failed) meanwhile. Its reply updates the info.
+        """
+        _LOGGER.debug('poll superseded by command, waiting for its reply')
+        return await asyncio.shield(self._sending_result)
+
+
+    def apply_room_status(self, unit):
+        """ Merge a unit entry from rooms.aspx into the current info.
+            Returns False if a full refresh is still required.
+        """
         if self._json is None:
-            return self._refresh_device_info()
+            return False
+
+        info = dict(self._json)
+        for room_key, (info_key, cast) in ROOM_FIELDS.items():
+            try:
+                info[info_key] = cast(unit[room_key])
+            except (KeyError, TypeError, ValueError):
+                continue
+
+        self._set_info(info)
+        self._last_info_time_s = time.time()
+
+        return not self.needs_full_update()
+
+
+    def needs_full_update(self):
+        """ Check whether the fields missing from rooms.aspx are stale.
+        """
+        if self._json is None:
+            return True
+
+        return (time.time() - self._last_full_time_s) >= self._full_lease_seconds
+
+
+    async def _async_is_info_valid(self, priority=PRIORITY_POLL):
+        metrics = self._authentication.get_metrics()
+        if self._json is None:
+            metrics.record_lease('info', False)
+            return await self._async_refresh_device_info(priority=priority)
 
         if (time.time() - self._last_info_time_s) >= self._info_lease_seconds:
             _LOGGER.debug('current settings out of date, refreshing')
-            return self._refresh_device_info()
+            metrics.record_lease('info', False)
+            return await self._async_refresh_device_info(priority=priority)
 
+        metrics.record_lease('info', True)
         return True
 
 
-    def _is_caps_valid(self):
+    async def _async_has_info(self):
+        # Commands are checked against the caps, so those must be loaded.
+        if not await self._async_is_caps_valid():
+            _LOGGER.error('no capabilities for unit %s', self._deviceid)
+            return False
+
+        # Stale info is still good enough to build a command from, e.g.
+        # when only cached local commands can be sent.
+        return await self._async_is_info_valid(PRIORITY_COMMAND) or (
+            self._json is not None and self._caps is not None)
+
+
+    async def _async_is_caps_valid(self):
+        metrics = self._authentication.get_metrics()
         if self._caps is None:
-            return self._refresh_device_caps()
+            metrics.record_lease('caps', False)
+            return await self._async_refresh_device_caps()
 
+        metrics.record_lease('caps', True)
         return True
 
 
-    def _send_command(self, command, retry=True):
+    async def _async_send_command(self, command, retry=True):
         _LOGGER.debug('command issued %s', command)
 
-        if not self._is_info_valid():
+        if self._is_cached(command):
+            if await self._async_send_local_commands(command):
+                self._apply_command_response(command, {})
+                return True
+            _LOGGER.debug('cached local command failed, using cloud')
+
+        if not await self._async_is_info_valid(PRIORITY_COMMAND):
             _LOGGER.error('data outdated, command %s failed', command)
             return False
 
-        req = requests.post('https://api.melview.net/api/unitcommand.aspx',
-                            cookies=self._authentication.get_cookie(),
-                            json={'unitid': self._deviceid, 'v': APIVERSION,
-                                  'commands': command, 'lc': 1})
-        if req.status_code == 200:
+        generation = self._authentication.get_generation()
+        reply = await self._authentication.async_post(
+            'unitcommand.aspx', {'unitid': self._deviceid, 'v': APIVERSION,
+                                 'commands': command, 'lc': 1},
+            PRIORITY_COMMAND, self._deviceid)
+        if reply.status == 200:
             _LOGGER.debug('command sent to remote')
+            resp = reply.json
+            self._apply_command_response(command, resp)
 
-            resp = req.json()
             if self._localip:
                 if 'lc' in resp:
-                    local_command = req.json()['lc']
-                    req = requests.post('http://{}/smart'.format(self._localip),
-                                        data=LOCAL_DATA.format(local_command))
-                    if req.status_code == 200:
-                        _LOGGER.debug('command sent locally')
-                    else:
-                        _LOGGER.error('local submission failed')
+                    # Cached by single command, so any combination of them
+                    # can be sent later.
+                    if ',' not in command:
+                        self._set_local_command(command, resp['lc'])
+                    await self._async_send_local_command(resp['lc'])
                 else:
                     _LOGGER.error('missing local command key')
 
             return True
-        if req.status_code == 401 and retry:
+        if reply.status == 401 and retry:
             _LOGGER.error('command send error 401 (trying to relogin)')
-            if self._authentication.login():
-                return self._send_command(command, retry=False)
-        else:
-            _LOGGER.error('unable to send command (invalid status code: %d',
-                          req.status_code)
+            if await self._authentication.async_relogin(generation):
+                return await self._async_send_command(command, retry=False)
+        elif reply.status is not None:
+            _LOGGER.error('unable to send command (invalid status code: %d)',
+                          reply.status)
 
         return False
 
-    
-    def force_update(self):
+
+    def _is_cached(self, command):
+        """ Check every part of a (combined) command can be sent over the
+            LAN from the cache.
+        """
+        return self._localip is not None and all(
+            part in self._local_commands for part in command.split(','))
+
+
+    async def _async_send_local_commands(self, command):
+        # Parts are sent in order, so power changes still go first.
+        for part in command.split(','):
+            if not await self._async_send_local_command(
+                    self._local_commands[part]):
+                return False
+        return True
+
+
+    async def _async_send_local_command(self, local_command):
+        reply = await self._authentication.async_post_local(
+            self._localip, LOCAL_DATA.format(local_command), PRIORITY_COMMAND,
+            self._deviceid)
+        if reply.status != 200:
+            _LOGGER.error('local submission failed (status code: %s)',
+                          reply.status)
+            return False
+
+        _LOGGER.debug('command sent locally')
+        return True
+
+
+    def _set_local_command(self, command, local_command):
+        if self._local_commands.get(command) == local_command:
+            return
+
+        self._local_commands[command] = local_command
+        if self._command_cache is not None:
+            self._command_cache.set(self._deviceid, command, local_command)
+
+
+    def get_prefetch_commands(self):
+        """ Get the uncached commands matching the current settings, which
+            can be encoded without changing anything on the unit.
+        """
+        state = self._state
+        if not self._localip or self._json is None or state.setmode is None:
+            return []
+
+        commands = ['PW{}'.format(int(state.power)),
+                    'MD{}'.format(state.setmode)]
+        if state.speed is not None:
+            commands.append('FS{:.2f}'.format(FAN[state.speed]))
+        if state.target_temperature is not None:
+            commands.append('TS{:.2f}'.format(state.target_temperature))
+
+        return [command for command in commands
+                if command not in self._local_commands]
+
+
+    async def async_prefetch_local_commands(self, retry=True):
+        """ Fetch and cache the local encoding of the current settings, so
+            switching back to them later does not need the cloud.
+            The settings are re-sent to the unit, so they are refreshed
+            first and units with a command under way are skipped.
+        """
+        if not self.get_prefetch_commands() or self._is_command_pending():
+            return True
+
+        if not await self._async_refresh_device_info(
+                priority=PRIORITY_BACKGROUND):
+            return False
+
+        commands = self.get_prefetch_commands()
+        if not commands or self._is_command_pending():
+            return True
+
+        generation = self._authentication.get_generation()
+        for command in commands:
+            reply = await self._authentication.async_post(
+                'unitcommand.aspx', {'unitid': self._deviceid,
+                                     'v': APIVERSION, 'commands': command,
+                                     'lc': 1}, PRIORITY_BACKGROUND)
+            if reply.status == 200 and 'lc' in reply.json:
+                self._set_local_command(command, reply.json['lc'])
+                self._apply_reply_state(reply.json)
+                continue
+
+            if reply.status == 401 and retry:
+                _LOGGER.error('prefetch error 401 (trying to re-login)')
+                if await self._authentication.async_relogin(generation):
+                    return await self.async_prefetch_local_commands(
+                        retry=False)
+            _LOGGER.debug('unable to prefetch local command %s', command)
+            return False
+
+        return True
+
+
+    def _apply_command_response(self, command, resp):
+        """ Use the state returned with a command as the new info, so the
+            next poll can be skipped. If no state came back, assume the
+            commands applied and expire the lease to confirm on next poll.
+        """
+        self._last_command_time_s = time.time()
+        if self._apply_reply_state(resp):
+            return
+
+        _LOGGER.debug('no state in command response, assuming applied')
+        info = dict(self._json or {})
+        for part in command.split(','):
+            if part[:2] not in COMMAND_FIELDS:
+                continue
+            info_key, cast = COMMAND_FIELDS[part[:2]]
+            try:
+                info[info_key] = cast(part[2:])
+            except ValueError:
+                continue
+        self._set_info(info)
+        self._last_info_time_s = 0
+
+
+    def _apply_reply_state(self, resp):
+        """ Use the full state returned with a command as the new info.
+            Returns False if the reply had no full state.
+        """
+        if not all(key in resp for key in FULL_FIELDS):
+            return False
+
+        self._set_info({key: val for key, val in resp.items() if key != 'lc'})
+        self._last_info_time_s = time.time()
+        self._last_full_time_s = self._last_info_time_s
+        return True
+
+
+    def _is_command_pending(self):
+        return self._pending_result is not None or \
+            self._sending_result is not None
+
+
+    async def _async_queue_command(self, *commands):
+        """ Queue commands, sending them with any others issued within the
+            debounce window as one request. Later commands of the same type
+            (e.g. TS) replace earlier ones.
+        """
+        for command in commands:
+            self._pending_commands.pop(command[:2], None)
+            self._pending_commands[command[:2]] = command
+
+        if self._pending_result is not None:
+            return await asyncio.shield(self._pending_result)
+
+        result = asyncio.get_running_loop().create_future()
+        self._pending_result = result
+        success = False
+        try:
+            await asyncio.sleep(self._command_debounce_seconds)
+            # Power changes go first, so the unit accepts the rest.
+            combined = ','.join(sorted(self._pending_commands.values(),
+                                       key=lambda cmd: cmd[:2] != 'PW'))
+            self._sending_commands = self._pending_commands
+            self._pending_commands = {}
+            self._pending_result = None
+            self._sending_result = result
+            success = await self._async_send_command(combined)
+        finally:
+            if self._pending_result is result:
+                self._pending_commands = {}
+                self._pending_result = None
+            if self._sending_result is result:
+                self._sending_commands = {}
+                self._sending_result = None
+            result.set_result(success)
+
+        return success
+
+
+    async def async_update(self):
+        """ Refresh info if the current lease has expired.
+        """
+        if not await self._async_is_caps_valid():
+            return False
+
+        return await self._async_is_info_valid()
+
+
+    async def async_force_update(self):
         """ Force info refresh
         """
 
-        return self._refresh_device_info()
+        return await self._async_refresh_device_info()
+
+
+    def force_update(self):
+        """ Force info refresh (blocking).
+        """
+        return self._authentication.run_blocking(self.async_force_update())
 
 
     def get_id(self):
@@ -266,200 +1193,665 @@ class MelViewDevice:
         return self._deviceid
 
 
+    def get_building_id(self):
+        """ Get the ID of the building the unit is in.
+        """
+        return self._buildingid
+
+
     def get_friendly_name(self):
         """ Get customised device name.
         """
         return self._friendlyname
 
 
+    def set_friendly_name(self, friendlyname):
+        """ Update the customised device name.
+        """
+        if friendlyname != self._friendlyname:
+            self._friendlyname = friendlyname
+            self._notify_listeners(['name'])
+
+
+    def get_info(self):
+        """ Get the raw settings from the last refresh, or None.
+        """
+        return self._json
+
+
+    def get_state(self):
+        """ Get the decoded settings from the last refresh.
+        """
+        return self._state
+
+
     def get_precision_halves(self):
         """ Get unit support for half degrees.
         """
-        if not self._is_caps_valid():
-            return False
-
-        return 'halfdeg' in self._caps and self._caps['halfdeg'] == 1
+        return self._state.precision_halves
 
 
     def get_temperature(self):
-        """ Get set temperature.
+        """ Get set temperature, or None if unknown.
         """
-        if not self._is_info_valid():
-            return 0
-
-        return float(self._json['settemp'])
+        return self._state.target_temperature
 
 
     def get_room_temperature(self):
-        """ Get current room temperature.
+        """ Get current room temperature, or None if unknown.
         """
-        if not self._is_info_valid():
-            return 0
+        return self._state.room_temperature
 
-        if not self._rtemp_list:
-            return 0 # Avoid div 0.
 
-        return round(sum(self._rtemp_list) / len(self._rtemp_list), 1)
+    def get_room_temperature_stats(self):
+        """ Get min, max and trend of the recent room temperatures.
+        """
+        return _stat_summary(self._rtemp)
 
 
     def get_outside_temperature(self):
-        """ Get current outside temperature.
+        """ Get current outside temperature, or None if unknown or
+            unsupported.
         """
-        if not 'hasoutdoortemp' in self._caps or self._caps['hasoutdoortemp'] == 0:
-            _LOGGER.error('outdoor temperature not supported')
-            return 0
-
-        if not self._is_info_valid():
-            return 0
+        return self._state.outside_temperature
 
-        if not self._otemp_list:
-            return 0 # Avoid div 0.
 
-        return round((sum(self._otemp_list) / len(self._otemp_list)), 1)
+    def get_outside_temperature_stats(self):
+        """ Get min, max and trend of the recent outside temperatures.
+        """
+        return _stat_summary(self._otemp)
 
 
     def get_speed(self):
-        """ Get the set fan speed.
+        """ Get the set fan speed, or None if unknown.
         """
-        if not self._is_info_valid():
-            return 'Auto'
+        return self._state.speed
 
-        for key, val in FAN.items():
-            if self._json['setfan'] == val:
-                return key
 
-        return 'Auto'
+    def get_mode(self):
+        """ Get the operating mode (HVAC_MODE_OFF while off), or None if
+            unknown.
+        """
+        return self._state.mode
 
 
+    def is_power_on(self):
+        """ Check unit is on.
+        """
+        return self._state.power
 
-    def get_mode(self):
-        """ Get the set mode.
+
+    def _get_pending(self, kind):
+        """ Value a queued or in-flight command of the given kind (e.g. PW)
+            is about to set, or None.
         """
-        if not self._is_info_valid():
-            return 'Auto'
+        for commands in (self._pending_commands, self._sending_commands):
+            if kind in commands:
+                return commands[kind][2:]
+        return None
 
-        if self.is_power_on():
-            for key, val in MODE.items():
-                if self._json['setmode'] == val:
-                    return key
 
-        return 'Auto'
+    def _is_power_pending_on(self):
+        power = self._get_pending('PW')
+        if power is None:
+            return self.is_power_on()
 
+        return power == '1'
 
-    def is_power_on(self):
-        """ Check unit is on.
-        """
-        if not self._is_info_valid():
-            return False
 
-        return self._json['power']
+    def _get_pending_setmode(self):
+        mode = self._get_pending('MD')
+        if mode is None:
+            return self._state.setmode
 
+        return int(mode)
 
-    def set_temperature(self, temperature):
-        """ Set the target temperature.
-        """
-        mode = self.get_mode()
-        min_temp = self._caps['max'][str(MODE[mode])]['min']
-        max_temp = self._caps['max'][str(MODE[mode])]['max']
+
+    def _temperature_command(self, temperature, mode=None):
+        # Limits are per set mode, which is kept even while the unit is off.
+        # Commands not yet applied count, so a new mode's limits are used.
+        if mode is None:
+            mode = self._get_pending_setmode()
+        limits = self._caps.get('max', {}).get(str(mode))
+        if limits is None:
+            _LOGGER.error('no temp limits for mode %s', mode)
+            return None
+        min_temp = limits['min']
+        max_temp = limits['max']
         if temperature < min_temp:
             _LOGGER.error('temp %.1f lower than min %d for mode %d',
                           temperature, min_temp, mode)
-            return False
+            return None
         if temperature > max_temp:
             _LOGGER.error('temp %.1f greater than max %d for mode %d',
                           temperature, max_temp, mode)
-            return False
-        return self._send_command('TS{:.2f}'.format(temperature))
-
+            return None
+        return 'TS{:.2f}'.format(temperature)
 
-    def set_speed(self, speed):
-        """ Set the fan speed.
-        """
-        if not self.is_power_on():
-            # Try turn on the unit if off.
-            if not self.power_on():
-                return False
 
-        if speed == 'Auto' and (not 'hasautofan' in self._caps or self._caps['hasautofan'] == 0):
+    def _speed_command(self, speed):
+        if speed == FAN_AUTO and (not 'hasautofan' in self._caps or self._caps['hasautofan'] == 0):
             _LOGGER.error('fan speed auto not supported')
-            return False
+            return None
         if speed not in FAN.keys():
-            _LOGGER.error('fan speed %d not supported', speed)
-            return False
-        return self._send_command('FS{:.2f}'.format(FAN[speed]))
+            _LOGGER.error('fan speed %s not supported', speed)
+            return None
+        return 'FS{:.2f}'.format(FAN[speed])
 
 
-    def set_mode(self, mode):
-        """ Set operating mode.
-        """
-        if not self.is_power_on():
-            # Try turn on the unit if off.
-            if not self.power_on():
-                return False
-
-        if mode == 'Auto' and (not 'hasautomode' in self._caps or self._caps['hasautomode'] == 0):
+    def _mode_command(self, mode):
+        if mode == HVAC_MODE_AUTO and (not 'hasautomode' in self._caps or self._caps['hasautomode'] == 0):
             _LOGGER.error('auto mode not supported')
-            return False
-        if mode == 'Dry' and (not 'hasdrymode' in self._caps or self._caps['hasdrymode'] == 0):
+            return None
+        if mode == HVAC_MODE_DRY and (not 'hasdrymode' in self._caps or self._caps['hasdrymode'] == 0):
             _LOGGER.error('dry mode not supported')
-            return False
-        if mode != 'Cool' and ('hascoolonly' in self._caps and self._caps['hascoolonly'] == 1):
+            return None
+        if mode != HVAC_MODE_COOL and ('hascoolonly' in self._caps and self._caps['hascoolonly'] == 1):
             _LOGGER.error('only cool mode supported')
-            return False
+            return None
         if mode not in MODE.keys():
-            _LOGGER.error('mode %d not supported', mode)
+            _LOGGER.error('mode %s not supported', mode)
+            return None
+        return 'MD{}'.format(MODE[mode])
+
+
+    async def _async_build_commands(self, build):
+        """ Build commands with build() (returning a list, or None if they
+            are invalid). Current info is used as-is if every command can
+            be sent over the LAN from the cache, so these never wait on
+            the cloud. Otherwise stale info is refreshed first.
+        """
+        if self._json is not None and self.has_caps():
+            commands = build()
+            if commands is not None and (
+                    not commands or self._is_cached(','.join(commands))):
+                return commands
+
+        if not await self._async_has_info():
+            return None
+
+        return build()
+
+
+    async def async_set_temperature(self, temperature):
+        """ Set the target temperature.
+        """
+        def _build():
+            command = self._temperature_command(temperature)
+            return None if command is None else [command]
+
+        commands = await self._async_build_commands(_build)
+        if commands is None:
             return False
-        return self._send_command('MD{}'.format(MODE[mode]))
+        return await self._async_queue_command(*commands)
 
 
-    def power_on(self):
+    async def async_set_speed(self, speed):
+        """ Set the fan speed, turning on the unit if off.
+        """
+        return await self.async_apply(speed=speed)
+
+
+    async def async_set_mode(self, mode):
+        """ Set operating mode, turning on the unit if off.
+        """
+        return await self.async_apply(mode=mode)
+
+
+    async def async_apply(self, power=None, mode=None, temperature=None,
+                          speed=None):
+        """ Apply several changes as one command. Setting a mode or fan
+            speed turns on the unit if off, unless power is given.
+            The temperature is checked against the limits of the new mode.
+        """
+        commands = await self._async_build_commands(
+            lambda: self._apply_commands(power, mode, temperature, speed))
+        if commands is None:
+            return False
+
+        if not commands:
+            return True
+        return await self._async_queue_command(*commands)
+
+
+    def _apply_commands(self, power, mode, temperature, speed):
+        if mode == HVAC_MODE_OFF:
+            mode = None
+            power = False
+
+        commands = []
+        if mode is not None:
+            commands.append(self._mode_command(mode))
+        if speed is not None:
+            commands.append(self._speed_command(speed))
+        if temperature is not None:
+            commands.append(self._temperature_command(
+                temperature, MODE.get(mode)))
+        if None in commands:
+            return None
+
+        if power is None and commands and not self._is_power_pending_on() \
+                and (mode is not None or speed is not None):
+            # Try turn on the unit if off.
+            power = True
+        if power is not None:
+            commands.insert(0, 'PW{}'.format(int(power)))
+
+        return commands
+
+
+    async def async_power_on(self):
         """ Turn on the unit.
         """
-        return self._send_command('PW1')
+        return await self._async_queue_command('PW1')
 
 
-    def power_off(self):
+    async def async_power_off(self):
         """ Turn off the unit.
         """
-        return self._send_command('PW0')
+        return await self._async_queue_command('PW0')
+
+
+    def set_temperature(self, temperature):
+        """ Set the target temperature (blocking).
+        """
+        return self._authentication.run_blocking(
+            self.async_set_temperature(temperature))
+
+
+    def set_speed(self, speed):
+        """ Set the fan speed (blocking).
+        """
+        return self._authentication.run_blocking(self.async_set_speed(speed))
+
+
+    def set_mode(self, mode):
+        """ Set operating mode (blocking).
+        """
+        return self._authentication.run_blocking(self.async_set_mode(mode))
+
+
+    def power_on(self):
+        """ Turn on the unit (blocking).
+        """
+        return self._authentication.run_blocking(self.async_power_on())
+
+
+    def power_off(self):
+        """ Turn off the unit (blocking).
+        """
+        return self._authentication.run_blocking(self.async_power_off())
 
 # ---------------------------------------------------------------
 
 class MelView:
     """ Handler for multiple melview devices under one user.
     """
-    def __init__(self, authentication, localcontrol=False):
+    def __init__(self, authentication, localcontrol=False, caps_cache=None,
+                 localstatus=False, smoothing=None, command_cache=None,
+                 buildings=None, units=None):
         self._authentication = authentication
         self._unitcount = 0
 
         self._localcontrol = localcontrol
+        self._localstatus = localstatus
+        self._smoothing = smoothing
+        self._caps_cache = caps_cache
+        self._command_cache = command_cache
+        self._devices = {}
 
+        # Allow-lists of building and unit ids, None for all.
+        self._buildings = _id_set(buildings)
+        self._units = _id_set(units)
 
-    def get_devices_list(self, retry=True):
-        """ Return all the devices found, as handlers.
+
+    async def _async_get_rooms(self, retry=True):
+        generation = self._authentication.get_generation()
+        reply = await self._authentication.async_post('rooms.aspx',
+                                                      {'unitid': 0})
+        if reply.status == 200:
+            return reply.json
+
+        if reply.status == 401 and retry:
+            _LOGGER.error('device list error 401 (trying to re-login)')
+            if await self._authentication.async_relogin(generation):
+                return await self._async_get_rooms(retry=False)
+        elif reply.status is not None:
+            _LOGGER.error('failed to get device list (status code invalid: %d)',
+                          reply.status)
+
+        return None
+
+
+    def _create_device(self, unitid, buildingid, room):
+        return MelViewDevice(unitid, buildingid, room, self._authentication,
+                             self._localcontrol, self._caps_cache,
+                             self._localstatus, self._smoothing,
+                             self._command_cache)
+
+
+    def restore_devices(self, entries):
+        """ Create the units from entries saved by get_registry(), with
+            their last known settings, without any request.
         """
         devices = []
+        for entry in entries:
+            if not self._is_managed(self._buildings, entry['buildingid']) \
+                    or not self._is_managed(self._units, entry['unitid']):
+                continue
+            device = self._create_device(entry['unitid'], entry['buildingid'],
+                                         entry['room'])
+            device.restore(entry.get('info'))
+            devices.append(device)
+
+        self._devices = {device.get_id(): device for device in devices}
+        self._unitcount = len(devices)
+        return devices
+
 
-        req = requests.post('https://api.melview.net/api/rooms.aspx',
-                            json={'unitid': 0},
-                            headers=HEADERS,
-                            cookies=self._authentication.get_cookie())
-        if req.status_code == 200:
-            reply = req.json()
-            for building in reply:
-                for unit in building['units']:
-                    devices.append(MelViewDevice(unit['unitid'],
+    def get_registry(self):
+        """ Return the managed units and their settings, for restore_devices.
+        """
+        return [{'unitid': device.get_id(),
+                 'buildingid': device.get_building_id(),
+                 'room': device.get_friendly_name(),
+                 'info': device.get_info()}
+                for device in self._devices.values()]
+
+
+    async def async_reconcile_devices(self):
+        """ Update the managed units from rooms.aspx, keeping the existing
+            handler of each unit and renaming it if needed.
+            Returns the added and removed devices, or None if the list is
+            unavailable.
+        """
+        reply = await self._async_get_rooms()
+        if reply is None:
+            return None
+
+        found = {}
+        for building in reply:
+            if not self._is_managed(self._buildings, building['buildingid']):
+                continue
+            for unit in building['units']:
+                if not self._is_managed(self._units, unit['unitid']):
+                    continue
+                device = self._devices.get(unit['unitid'])
+                if device is None:
+                    device = self._create_device(unit['unitid'],
                                                  building['buildingid'],
-                                                 unit['room'],
-                                                 self._authentication,
-                                                 self._localcontrol))
+                                                 unit['room'])
+                elif device.get_friendly_name() != unit['room']:
+                    _LOGGER.debug('unit %s renamed to %s', unit['unitid'],
+                                  unit['room'])
+                    device.set_friendly_name(unit['room'])
+                found[unit['unitid']] = device
+
+        added = [device for unitid, device in found.items()
+                 if unitid not in self._devices]
+        removed = [device for unitid, device in self._devices.items()
+                   if unitid not in found]
+
+        self._devices = found
+        self._unitcount = len(found)
+        return added, removed
+
+
+    async def async_discover_devices(self):
+        """ Find the units of this account with a single request, keeping
+            those within the building and unit allow-lists. The units are
+            not contacted; their caps and settings are loaded by the first
+            refresh. Returns None if the list is unavailable.
+        """
+        if await self.async_reconcile_devices() is None:
+            return None
 
-        elif req.status_code == 401 and retry:
-            _LOGGER.error('device list error 401 (trying to re-login)')
-            if self._authentication.login():
-                return self.get_devices_list(retry=False)
-        else:
-            _LOGGER.error('failed to get device list (status code invalid: %d)',
-                          req.status_code)
+        return list(self._devices.values())
+
+
+    @staticmethod
+    def _is_managed(allowed, ident):
+        return allowed is None or str(ident) in allowed
+
+
+    async def async_get_devices_list(self, max_parallel=DEFAULT_MAX_PARALLEL,
+                                     on_device=None):
+        """ Return all the devices found, as handlers.
+            Devices are set up concurrently (at most max_parallel at once),
+            and on_device is called with each one as soon as it is ready.
+        """
+        devices = await self.async_discover_devices()
+        if devices is None:
+            return []
+
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def _setup(device):
+            async with semaphore:
+                await device.async_setup()
+            if on_device is not None:
+                on_device(device)
+
+        await asyncio.gather(*[_setup(device) for device in devices])
 
         return devices
+
+
+    def get_devices_list(self):
+        """ Return all the devices found, as handlers (blocking).
+        """
+        return self._authentication.run_blocking(self.async_get_devices_list())
+
+
+    async def async_revalidate_caps(self, max_parallel=DEFAULT_MAX_PARALLEL):
+        """ Refresh stored capabilities that have passed their TTL.
+            Intended to run in the background after setup.
+        """
+        stale = [device for device in self._devices.values()
+                 if device.needs_caps_revalidation()]
+        if not stale:
+            return True
+
+        _LOGGER.debug('revalidating caps for %d units', len(stale))
+
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def _revalidate(device):
+            async with semaphore:
+                return await device.async_revalidate_caps()
+
+        results = await asyncio.gather(*[_revalidate(device)
+                                         for device in stale])
+        return all(results)
+
+
+    async def async_prefetch_local_commands(self,
+                                            max_parallel=DEFAULT_MAX_PARALLEL):
+        """ Cache the local encoding of each unit's current settings.
+            Intended to run in the background after setup.
+        """
+        pending = [device for device in self._devices.values()
+                   if device.get_prefetch_commands()]
+        if not pending:
+            return True
+
+        _LOGGER.debug('prefetching local commands for %d units',
+                      len(pending))
+
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def _prefetch(device):
+            async with semaphore:
+                return await device.async_prefetch_local_commands()
+
+        results = await asyncio.gather(*[_prefetch(device)
+                                         for device in pending])
+        return all(results)
+
+
+    def is_cloud_available(self):
+        """ Check the cloud API is not being paused after failures.
+        """
+        return self._authentication.is_cloud_available()
+
+
+    def find_devices(self, unitids=None, buildings=None):
+        """ Return the managed devices matching any of the given unit or
+            building ids, or all of them if neither is given.
+        """
+        if unitids is None and buildings is None:
+            return list(self._devices.values())
+
+        unitids = _id_set(unitids or [])
+        buildings = _id_set(buildings or [])
+        return [device for device in self._devices.values()
+                if str(device.get_id()) in unitids
+                or str(device.get_building_id()) in buildings]
+
+
+    async def async_apply(self, unitids=None, buildings=None,
+                          max_parallel=DEFAULT_MAX_PARALLEL, **changes):
+        """ Apply power, mode, temperature and/or speed changes (see
+            MelViewDevice.async_apply) to the matching units, at most
+            max_parallel at once. Returns the result for each unit keyed by
+            unitid: True, False, or the exception it raised.
+        """
+        devices = self.find_devices(unitids, buildings)
+        _LOGGER.debug('applying %s to %d units', changes, len(devices))
+
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def _apply(device):
+            async with semaphore:
+                return await device.async_apply(**changes)
+
+        results = await asyncio.gather(*[_apply(device) for device in devices],
+                                       return_exceptions=True)
+        for device, result in zip(devices, results):
+            if isinstance(result, Exception):
+                _LOGGER.error('unable to apply changes to %s: %r',
+                              device.get_friendly_name(), result)
+
+        return {device.get_id(): result
+                for device, result in zip(devices, results)}
+
+
+    def get_metrics(self):
+        """ Return the request metrics for this account.
+        """
+        return self._authentication.get_metrics()
+
+
+    def get_devices(self):
+        """ Return the devices found by the last discovery.
+        """
+        return list(self._devices.values())
+
+
+    async def async_refresh_devices(self, max_parallel=DEFAULT_MAX_PARALLEL,
+                                    lease_slack=0):
+        """ Refresh the known units whose info lease has expired (or will
+            within lease_slack). Units with local status are read over the
+            LAN first, even without a login. The rest use a single
+            rooms.aspx call, and only fall back to per-unit requests (at
+            most max_parallel at once).
+            Each unit records whether its refresh failed. Returns False if
+            no unit due could be refreshed.
+        """
+        logged_in = await self._authentication.async_refresh_login()
+
+        semaphore = asyncio.Semaphore(max_parallel)
+
+        async def _setup_caps(device):
+            async with semaphore:
+                return await device.async_setup_caps()
+
+        # Units discovered but not yet contacted.
+        unready = [device for device in self._devices.values()
+                   if not device.has_caps()]
+        if logged_in:
+            await asyncio.gather(*[_setup_caps(device) for device in unready])
+
+        stale = {unitid: device for unitid, device in self._devices.items()
+                 if device.is_info_stale(lease_slack)}
+        metrics = self._authentication.get_metrics()
+        for device in self._devices.values():
+            metrics.record_lease('poll', device.get_id() not in stale)
+        if not stale:
+            return True
+
+        refreshed = set()
+        await self._async_refresh_stale(stale, refreshed, semaphore,
+                                        logged_in)
+
+        for unitid in refreshed:
+            self._devices[unitid].set_update_failed(False)
+        # Keep serving the last known state while the cloud is paused, and
+        # for units that could not be tried without a login.
+        if self.is_cloud_available():
+            for unitid, device in stale.items():
+                if unitid not in refreshed and \
+                        (logged_in or device.has_local_status()):
+                    device.set_update_failed(True)
+
+        return bool(refreshed) or not stale
+
+
+    async def _async_refresh_stale(self, stale, refreshed, semaphore,
+                                   logged_in):
+        """ Refresh the given units, removing them from stale and adding
+            their ids to refreshed as they are.
+        """
+        async def _refresh_local(device):
+            async with semaphore:
+                return await device.async_refresh_local_info()
+
+        local = [device for device in stale.values()
+                 if device.has_local_status()]
+        results = await asyncio.gather(*[_refresh_local(device)
+                                         for device in local])
+        for device, result in zip(local, results):
+            if result:
+                refreshed.add(device.get_id())
+                if not device.needs_full_update():
+                    del stale[device.get_id()]
+
+        if not stale or not logged_in:
+            return
+
+        # Units never refreshed need a full refresh, so rooms.aspx is only
+        # worth fetching if some of the stale units have info already.
+        # Without it every stale unit is refreshed on its own.
+        reply = None
+        if any(device.is_ready() for device in stale.values()):
+            reply = await self._async_get_rooms()
+
+        # The reply covers every unit, so current ones are renewed too.
+        for building in reply or []:
+            for unit in building['units']:
+                device = self._devices.get(unit['unitid'])
+                if device is None:
+                    continue
+                if device.has_local_status() and unit['unitid'] not in stale:
+                    continue
+                if device.apply_room_status(unit):
+                    refreshed.add(unit['unitid'])
+                    stale.pop(unit['unitid'], None)
+
+        if not stale:
+            return
+
+        _LOGGER.debug('refreshing %d of %d units individually',
+                      len(stale), len(self._devices))
+
+        async def _refresh(device):
+            async with semaphore:
+                return await device.async_force_update()
+
+        devices = list(stale.values())
+        results = await asyncio.gather(*[_refresh(device)
+                                         for device in devices])
+        for device, result in zip(devices, results):
+            if result:
+                refreshed.add(device.get_id())
+                del stale[device.get_id()]
@@ -0,0 +1,206 @@
+#!/usr/local/bin/python3
+
+'''
+    Author: zacharyrs
+
+    How to install:
+        Refer to README.md
+
+    License:
+                DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+                        Version 2, December 2004
+
+        Everyone is permitted to copy and distribute verbatim or modified
+        copies of this license document, and changing it is allowed as long
+        as the name is changed.
+
+                  DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+          TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+
+         0. You just DO WHAT THE FUCK YOU WANT TO.
+'''
+
+import bisect
+import logging
+from collections import Counter
+
+_LOGGER = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STATUS_ERROR = 'error' # No reply received.
+
+SLOW_REQUEST_SECONDS = 2.0 # Log requests slower than this.
+
+
+# ---------------------------------------------------------------
+
+class LatencyHistogram:
+    """ Fixed-bucket latency histogram.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+
+
+    def add(self, seconds):
+        """ Record one request duration.
+        """
+        self._counts[bisect.bisect_left(self._buckets, seconds)] += 1
+        self._count += 1
+        self._sum += seconds
+        self._max = max(self._max, seconds)
+
+
+    @property
+    def count(self):
+        """ Number of recorded durations.
+        """
+        return self._count
+
+
+    @property
+    def total(self):
+        """ Sum of recorded durations, in seconds.
+        """
+        return self._sum
+
+
+    def percentile(self, pct):
+        """ Upper bound of the bucket holding the given percentile.
+        """
+        if not self._count:
+            return 0.0
+
+        target = pct / 100 * self._count
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= target:
+                if index < len(self._buckets):
+                    return self._buckets[index]
+                break
+        return self._max
+
+
+    def as_dict(self):
+        """ Summary in milliseconds, with the raw bucket counts.
+        """
+        labels = ['le_{:g}'.format(bound) for bound in self._buckets]
+        return {
+            'count': self._count,
+            'avg_ms': round(1000 * self._sum / self._count, 1)
+                      if self._count else 0.0,
+            'p95_ms': round(1000 * self.percentile(95), 1),
+            'max_ms': round(1000 * self._max, 1),
+            'buckets': dict(zip(labels + ['le_inf'], self._counts))
+        }
+
+# ---------------------------------------------------------------
+
+class MelViewMetrics:
+    """ Request and cache counters for one melview account.
+    """
+    def __init__(self, slow_seconds=SLOW_REQUEST_SECONDS):
+        self._slow_seconds = slow_seconds
+        self._requests = Counter()
+        self._statuses = {}
+        self._latency = {}
+        self._logins = 0
+        self._lease_hits = Counter()
+        self._lease_misses = Counter()
+
+
+    def record_request(self, endpoint, status, seconds):
+        """ Record one HTTP request (status None if no reply came back).
+        """
+        self._requests[endpoint] += 1
+        self._statuses.setdefault(endpoint, Counter())[
+            STATUS_ERROR if status is None else status] += 1
+        self._latency.setdefault(endpoint, LatencyHistogram()).add(seconds)
+
+        if seconds >= self._slow_seconds:
+            _LOGGER.warning('slow %s request: %.1fs (status %s)', endpoint,
+                            seconds, STATUS_ERROR if status is None else status)
+
+
+    def record_login(self):
+        """ Record a login.aspx attempt.
+        """
+        self._logins += 1
+
+
+    def record_lease(self, kind, hit):
+        """ Record whether cached info or caps could be used without a fetch.
+        """
+        if hit:
+            self._lease_hits[kind] += 1
+        else:
+            self._lease_misses[kind] += 1
+
+
+    def get_request_count(self, endpoint=None):
+        """ Total requests, or requests to one endpoint.
+        """
+        if endpoint is not None:
+            return self._requests[endpoint]
+
+        return sum(self._requests.values())
+
+
+    def get_login_count(self):
+        """ Total login attempts.
+        """
+        return self._logins
+
+
+    def get_lease_hit_rate(self, kind=None):
+        """ Fraction of lease checks served from cache, or None if unused.
+        """
+        kinds = [kind] if kind is not None else \
+            set(self._lease_hits) | set(self._lease_misses)
+        hits = sum(self._lease_hits[key] for key in kinds)
+        total = hits + sum(self._lease_misses[key] for key in kinds)
+        if not total:
+            return None
+
+        return hits / total
+
+
+    def get_average_latency(self):
+        """ Mean request duration in seconds across all endpoints.
+        """
+        count = sum(histogram.count for histogram in self._latency.values())
+        if not count:
+            return None
+
+        return sum(histogram.total for histogram in self._latency.values()) \
+            / count
+
+
+    def get_latency(self, endpoint):
+        """ Latency histogram for one endpoint, or None if unused.
+        """
+        return self._latency.get(endpoint)
+
+
+    def as_dict(self):
+        """ Everything recorded so far, for diagnostics and attributes.
+        """
+        return {
+            'requests': dict(self._requests),
+            'statuses': {endpoint: {str(status): count
+                                    for status, count in statuses.items()}
+                         for endpoint, statuses in self._statuses.items()},
+            'latency': {endpoint: histogram.as_dict()
+                        for endpoint, histogram in self._latency.items()},
+            'logins': self._logins,
+            'lease_hits': dict(self._lease_hits),
+            'lease_misses': dict(self._lease_misses)
+        }
+
+# ---------------------------------------------------------------
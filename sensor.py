@@ -0,0 +1,235 @@
+#!/usr/local/bin/python3
+
+'''
+    Author: zacharyrs
+
+    How to install:
+        Refer to README.md
+
+    License:
+                DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+                        Version 2, December 2004
+
+        Everyone is permitted to copy and distribute verbatim or modified
+        copies of this license document, and changing it is allowed as long
+        as the name is changed.
+
+                  DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+          TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+
+         0. You just DO WHAT THE FUCK YOU WANT TO.
+'''
+
+import logging
+
+from homeassistant.components.sensor import (
+    STATE_CLASS_MEASUREMENT,
+    SensorEntity
+)
+from homeassistant.const import (
+    DEVICE_CLASS_TEMPERATURE,
+    PERCENTAGE,
+    TEMP_CELSIUS
+)
+from homeassistant.helpers.update_coordinator import CoordinatorEntity
+
+from .const import DOMAIN
+from .entity import MelViewDeviceEntity
+
+_LOGGER = logging.getLogger(__name__)
+
+# kind -> (name, unit)
+METRIC_SENSORS = {
+    'requests': ('Requests', 'requests'),
+    'latency': ('Request Latency', 'ms'),
+    'logins': ('Logins', 'logins'),
+    'lease_hit_rate': ('Cache Hit Rate', PERCENTAGE)
+}
+
+# snapshot field -> (name, unit, device class)
+DEVICE_SENSORS = {
+    'room_temperature': ('Room Temperature', TEMP_CELSIUS,
+                         DEVICE_CLASS_TEMPERATURE),
+    'outside_temperature': ('Outside Temperature', TEMP_CELSIUS,
+                            DEVICE_CLASS_TEMPERATURE),
+    'mode': ('Mode', None, None)
+}
+
+
+# ---------------------------------------------------------------
+
+class MelViewDeviceSensor(MelViewDeviceEntity, SensorEntity):
+    """ One field of a unit's snapshot, updated by the same refresh as the
+        climate entity.
+    """
+    def __init__(self, coordinator, device, field):
+        super().__init__(coordinator, device, [field])
+        self._field = field
+
+        self._label, self._unit, self._device_class = DEVICE_SENSORS[field]
+        self._unique_id = '{}_{}'.format(device.get_id(), field)
+
+
+    @property
+    def name(self):
+        """ Diplay name for HASS
+        """
+        return 'MelView {} {}'.format(self._device.get_friendly_name(),
+                                      self._label)
+
+
+    @property
+    def unique_id(self):
+        """ Get unique_id for HASS
+        """
+        return self._unique_id
+
+
+    @property
+    def available(self):
+        """ Unavailable until the unit has been refreshed once, or while
+            it does not report this field
+        """
+        return super().available and self.native_value is not None
+
+
+    @property
+    def device_class(self):
+        """ Device class of the field
+        """
+        return self._device_class
+
+
+    @property
+    def state_class(self):
+        """ Temperatures are measurements
+        """
+        if self._unit is None:
+            return None
+
+        return STATE_CLASS_MEASUREMENT
+
+
+    @property
+    def native_unit_of_measurement(self):
+        """ Unit of the field
+        """
+        return self._unit
+
+
+    @property
+    def native_value(self):
+        """ Current value from the shared snapshot
+        """
+        return getattr(self._device.get_state(), self._field)
+
+# ---------------------------------------------------------------
+
+class MelViewMetricSensor(CoordinatorEntity, SensorEntity):
+    """ Request metrics of one melview account, refreshed every cycle.
+    """
+    def __init__(self, coordinator, melview, account, kind):
+        super().__init__(coordinator)
+        self._metrics = melview.get_metrics()
+        self._kind = kind
+
+        label, self._unit = METRIC_SENSORS[kind]
+        self._name = 'MelView {} {}'.format(account, label)
+        self._unique_id = '{}_{}_{}'.format(DOMAIN, account, kind)
+
+
+    @property
+    def name(self):
+        """ Diplay name for HASS
+        """
+        return self._name
+
+
+    @property
+    def unique_id(self):
+        """ Get unique_id for HASS
+        """
+        return self._unique_id
+
+
+    @property
+    def native_unit_of_measurement(self):
+        """ Unit of the metric
+        """
+        return self._unit
+
+
+    @property
+    def native_value(self):
+        """ Current metric value
+        """
+        if self._kind == 'requests':
+            return self._metrics.get_request_count()
+
+        if self._kind == 'logins':
+            return self._metrics.get_login_count()
+
+        if self._kind == 'latency':
+            latency = self._metrics.get_average_latency()
+            return None if latency is None else round(1000 * latency, 1)
+
+        rate = self._metrics.get_lease_hit_rate()
+        return None if rate is None else round(100 * rate, 1)
+
+
+    @property
+    def extra_state_attributes(self):
+        """ Per-endpoint breakdown behind the metric
+        """
+        metrics = self._metrics.as_dict()
+        if self._kind == 'requests':
+            return {'endpoints': metrics['requests'],
+                    'statuses': metrics['statuses']}
+
+        if self._kind == 'latency':
+            return metrics['latency']
+
+        if self._kind == 'lease_hit_rate':
+            return {'hits': metrics['lease_hits'],
+                    'misses': metrics['lease_misses']}
+
+        return {}
+
+# ---------------------------------------------------------------
+
+async def async_setup_platform(hass, config, async_add_entities,
+                               discovery_info=None):
+    """ Set up the sensors for a melview account set up by the climate
+        platform.
+    """
+    if discovery_info is None:
+        return
+
+    account = discovery_info['account']
+    data = hass.data[DOMAIN][account]
+
+    def _add_devices(devices):
+        entities = []
+        for device in devices:
+            device_entities = [MelViewDeviceSensor(data['coordinator'],
+                                                   device, field)
+                               for field in DEVICE_SENSORS]
+            data['entities'].setdefault(device.get_id(), []).extend(
+                device_entities)
+            entities.extend(device_entities)
+        async_add_entities(entities)
+
+    if discovery_info.get('sensors'):
+        data['platforms']['sensor'] = _add_devices
+        _add_devices(data['melview'].get_devices())
+
+    entities = []
+    if discovery_info.get('metrics'):
+        for kind in METRIC_SENSORS:
+            entities.append(MelViewMetricSensor(data['coordinator'],
+                                                data['melview'], account,
+                                                kind))
+
+    async_add_entities(entities)
+
+# ---------------------------------------------------------------
@@ -0,0 +1,196 @@
+#!/usr/local/bin/python3
+
+'''
+    Author: zacharyrs
+
+    How to install:
+        Refer to README.md
+
+    License:
+                DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+                        Version 2, December 2004
+
+        Everyone is permitted to copy and distribute verbatim or modified
+        copies of this license document, and changing it is allowed as long
+        as the name is changed.
+
+                  DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+          TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+
+         0. You just DO WHAT THE FUCK YOU WANT TO.
+'''
+
+import bisect
+import logging
+from collections import deque
+
+_LOGGER = logging.getLogger(__name__)
+
+FILTER_MEAN = 'mean'
+FILTER_EMA = 'ema'
+FILTER_MEDIAN = 'median'
+FILTERS = (FILTER_MEAN, FILTER_EMA, FILTER_MEDIAN)
+
+DEFAULT_WINDOW = 10
+DEFAULT_EMA_ALPHA = 0.3
+MAX_REJECTED = 3 # Accept a sustained jump after this many readings.
+
+
+# ---------------------------------------------------------------
+
+class RollingStat:
+    """ Fixed-size window of sensor readings.
+        Everything is worked out as readings are added, so reads are O(1).
+        Adding is O(1) amortised, except for the median filter, which keeps
+        a sorted copy of the window updated by bisection.
+    """
+    def __init__(self, window=DEFAULT_WINDOW, method=FILTER_MEAN,
+                 alpha=DEFAULT_EMA_ALPHA, outlier_delta=None):
+        if method not in FILTERS:
+            _LOGGER.error('unknown filter %s, using %s', method, FILTER_MEAN)
+            method = FILTER_MEAN
+
+        self._window = [0.0] * max(1, window)
+        self._method = method
+        self._alpha = alpha
+        self._outlier_delta = outlier_delta
+
+        self._index = 0
+        self._count = 0
+        self._added = 0
+        self._sum = 0.0
+        self._ema = None
+        self._rejected = 0
+
+        # (reading number, value), increasing and decreasing respectively,
+        # so the window's minimum and maximum are at the front.
+        self._min_queue = deque()
+        self._max_queue = deque()
+        self._sorted = []
+
+        self._value = None
+        self._min = None
+        self._max = None
+        self._trend = 0.0
+
+
+    def __len__(self):
+        return self._count
+
+
+    def _is_outlier(self, value):
+        if self._outlier_delta is None or self._value is None:
+            return False
+
+        if abs(value - self._value) <= self._outlier_delta:
+            self._rejected = 0
+            return False
+
+        self._rejected += 1
+        if self._rejected >= MAX_REJECTED:
+            _LOGGER.debug('accepting sustained change to %.1f', value)
+            self._rejected = 0
+            return False
+
+        _LOGGER.debug('rejecting outlier %.1f (current %.1f)',
+                      value, self._value)
+        return True
+
+
+    def add(self, value):
+        """ Add a reading, returning False if it was rejected as an outlier.
+        """
+        value = float(value)
+        if self._is_outlier(value):
+            return False
+
+        size = len(self._window)
+        if self._count == size:
+            evicted = self._window[self._index]
+            self._sum -= evicted
+            if self._method == FILTER_MEDIAN:
+                del self._sorted[bisect.bisect_left(self._sorted, evicted)]
+        else:
+            self._count += 1
+        self._window[self._index] = value
+        self._sum += value
+        self._index = (self._index + 1) % size
+
+        if self._ema is None:
+            self._ema = value
+        else:
+            self._ema += self._alpha * (value - self._ema)
+
+        self._added += 1
+        self._min = self._push(self._min_queue, value, lambda last: last >= value)
+        self._max = self._push(self._max_queue, value, lambda last: last <= value)
+        if self._count > 1:
+            oldest = self._window[self._index if self._count == size else 0]
+            self._trend = (value - oldest) / (self._count - 1)
+
+        if self._method == FILTER_EMA:
+            self._value = self._ema
+        elif self._method == FILTER_MEDIAN:
+            bisect.insort(self._sorted, value)
+            middle = self._count // 2
+            if self._count % 2:
+                self._value = self._sorted[middle]
+            else:
+                self._value = (self._sorted[middle - 1] +
+                               self._sorted[middle]) / 2
+        else:
+            self._value = self._sum / self._count
+
+        return True
+
+
+    def _push(self, queue, value, replaces):
+        """ Add a reading to a min or max queue, dropping the readings it
+            makes irrelevant and those that left the window. Returns the
+            extreme of the window.
+        """
+        while queue and replaces(queue[-1][1]):
+            queue.pop()
+        queue.append((self._added, value))
+        while queue[0][0] <= self._added - len(self._window):
+            queue.popleft()
+        return queue[0][1]
+
+
+    def get_readings(self):
+        """ Get the readings in the window, oldest first.
+        """
+        if self._count < len(self._window):
+            return self._window[:self._count]
+
+        return self._window[self._index:] + self._window[:self._index]
+
+
+    @property
+    def value(self):
+        """ Smoothed reading, or None before the first one.
+        """
+        return self._value
+
+
+    @property
+    def minimum(self):
+        """ Lowest reading in the window.
+        """
+        return self._min
+
+
+    @property
+    def maximum(self):
+        """ Highest reading in the window.
+        """
+        return self._max
+
+
+    @property
+    def trend(self):
+        """ Average change per reading across the window.
+        """
+        return self._trend
+
+# ---------------------------------------------------------------
@@ -0,0 +1,184 @@
+#!/usr/local/bin/python3
+
+'''
+    Author: zacharyrs
+
+    How to install:
+        Refer to README.md
+
+    License:
+                DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+                        Version 2, December 2004
+
+        Everyone is permitted to copy and distribute verbatim or modified
+        copies of this license document, and changing it is allowed as long
+        as the name is changed.
+
+                  DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+          TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+
+         0. You just DO WHAT THE FUCK YOU WANT TO.
+'''
+
+import logging
+import time
+
+from homeassistant.helpers.storage import Store
+
+_LOGGER = logging.getLogger(__name__)
+
+STORAGE_VERSION = 1
+SAVE_DELAY_SECONDS = 10
+
+CAPS_STORAGE_KEY = 'melview.caps'
+CAPS_TTL_SECONDS = 24 * 60 * 60 # Capabilities barely change.
+
+AUTH_STORAGE_KEY = 'melview.auth'
+
+COMMANDS_STORAGE_KEY = 'melview.commands'
+
+DEVICES_STORAGE_KEY = 'melview.devices'
+DEVICES_SAVE_SECONDS = 5 * 60 # Settings change every refresh; save less often.
+
+
+# ---------------------------------------------------------------
+
+class MelViewCapsCache:
+    """ Persist unit capabilities between restarts, keyed by unitid.
+    """
+    def __init__(self, hass, ttl=CAPS_TTL_SECONDS):
+        self._store = Store(hass, STORAGE_VERSION, CAPS_STORAGE_KEY)
+        self._ttl = ttl
+        self._data = {}
+
+
+    async def async_load(self):
+        """ Load stored capabilities from disk.
+        """
+        self._data = await self._store.async_load() or {}
+        _LOGGER.debug('loaded cached caps for %d units', len(self._data))
+
+
+    def get(self, unitid):
+        """ Return the stored capabilities, or None if unknown.
+        """
+        entry = self._data.get(str(unitid))
+        if entry is None:
+            return None
+
+        return entry['caps']
+
+
+    def is_fresh(self, unitid):
+        """ Check the stored capabilities are within their TTL.
+        """
+        entry = self._data.get(str(unitid))
+        if entry is None:
+            return False
+
+        return (time.time() - entry['time']) < self._ttl
+
+
+    def set(self, unitid, caps):
+        """ Store new capabilities, saving to disk shortly after.
+        """
+        self._data[str(unitid)] = {'caps': caps, 'time': time.time()}
+        self._store.async_delay_save(lambda: self._data, SAVE_DELAY_SECONDS)
+
+# ---------------------------------------------------------------
+
+class MelViewCookieStore:
+    """ Persist login cookies between restarts, keyed by account email.
+    """
+    def __init__(self, hass):
+        self._store = Store(hass, STORAGE_VERSION, AUTH_STORAGE_KEY,
+                            private=True)
+        self._data = {}
+
+
+    async def async_load(self):
+        """ Load stored cookies from disk.
+        """
+        self._data = await self._store.async_load() or {}
+
+
+    def get(self, email):
+        """ Return the stored cookie and expiry, or None if unknown.
+        """
+        return self._data.get(email)
+
+
+    def set(self, email, cookie, expires):
+        """ Store a new cookie, saving to disk shortly after.
+        """
+        self._data[email] = {'cookie': cookie, 'expires': expires}
+        self._store.async_delay_save(lambda: self._data, SAVE_DELAY_SECONDS)
+
+# ---------------------------------------------------------------
+
+class MelViewCommandCache:
+    """ Persist the units' local command encodings between restarts,
+        keyed by unitid then command.
+    """
+    def __init__(self, hass):
+        self._store = Store(hass, STORAGE_VERSION, COMMANDS_STORAGE_KEY,
+                            private=True)
+        self._data = {}
+
+
+    async def async_load(self):
+        """ Load stored local commands from disk.
+        """
+        self._data = await self._store.async_load() or {}
+        _LOGGER.debug('loaded local commands for %d units', len(self._data))
+
+
+    def get(self, unitid):
+        """ Return the stored local commands of a unit.
+        """
+        return self._data.get(str(unitid), {})
+
+
+    def set(self, unitid, command, local_command):
+        """ Store a local command, saving to disk shortly after.
+        """
+        self._data.setdefault(str(unitid), {})[command] = local_command
+        self._store.async_delay_save(lambda: self._data, SAVE_DELAY_SECONDS)
+
+# ---------------------------------------------------------------
+
+class MelViewDeviceRegistry:
+    """ Persist each account's units and their last settings between
+        restarts, keyed by account email.
+    """
+    def __init__(self, hass):
+        self._store = Store(hass, STORAGE_VERSION, DEVICES_STORAGE_KEY)
+        self._data = {}
+        self._saved_s = {}
+
+
+    async def async_load(self):
+        """ Load stored units from disk.
+        """
+        self._data = await self._store.async_load() or {}
+
+
+    def get(self, email):
+        """ Return the stored units of an account, or None if unknown.
+        """
+        return self._data.get(email)
+
+
+    def set(self, email, units, force=False):
+        """ Store the units of an account. Saving to disk is limited to
+            once every few minutes per account unless forced.
+        """
+        self._data[email] = units
+        saved_s = self._saved_s.get(email, 0)
+        if not force and (time.time() - saved_s) < DEVICES_SAVE_SECONDS:
+            return
+
+        self._saved_s[email] = time.time()
+        self._store.async_delay_save(lambda: self._data, SAVE_DELAY_SECONDS)
+
+# ---------------------------------------------------------------
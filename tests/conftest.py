@@ -0,0 +1,8 @@
+""" Make the component modules without Home Assistant imports importable
+    on their own, e.g. `import throttle`.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
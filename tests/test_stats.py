@@ -0,0 +1,81 @@
+""" Tests for the rolling sensor statistics.
+"""
+
+import random
+
+import pytest
+
+from stats import (
+    FILTER_EMA,
+    FILTER_MEAN,
+    FILTER_MEDIAN,
+    MAX_REJECTED,
+    RollingStat
+)
+
+
+@pytest.mark.parametrize('method', [FILTER_MEAN, FILTER_MEDIAN, FILTER_EMA])
+@pytest.mark.parametrize('window', [1, 2, 5])
+def test_matches_window(method, window):
+    rng = random.Random(window)
+    stat = RollingStat(window=window, method=method)
+    added = []
+    for _ in range(200):
+        # Repeat values often so ties in the queues get exercised.
+        value = rng.choice([18.0, 20.0, 22.5, round(rng.uniform(15, 25), 1)])
+        stat.add(value)
+        added.append(value)
+        readings = added[-window:]
+
+        assert stat.get_readings() == readings
+        assert stat.minimum == min(readings)
+        assert stat.maximum == max(readings)
+        if len(readings) > 1:
+            expected = (readings[-1] - readings[0]) / (len(readings) - 1)
+            assert stat.trend == pytest.approx(expected)
+        if method == FILTER_MEAN:
+            assert stat.value == pytest.approx(sum(readings) / len(readings))
+        elif method == FILTER_MEDIAN:
+            ordered = sorted(readings)
+            middle = len(ordered) // 2
+            if len(ordered) % 2:
+                expected = ordered[middle]
+            else:
+                expected = (ordered[middle - 1] + ordered[middle]) / 2
+            assert stat.value == pytest.approx(expected)
+
+
+def test_ema_follows_recurrence():
+    stat = RollingStat(window=3, method=FILTER_EMA, alpha=0.25)
+    expected = None
+    for value in (20.0, 24.0, 18.0, 22.0, 30.0):
+        stat.add(value)
+        expected = value if expected is None else \
+            expected + 0.25 * (value - expected)
+        assert stat.value == pytest.approx(expected)
+
+
+def test_outlier_spike_is_rejected():
+    stat = RollingStat(window=5, outlier_delta=3)
+    for value in (20.0, 20.5, 21.0):
+        assert stat.add(value)
+
+    assert not stat.add(35.0)
+    assert stat.get_readings() == [20.0, 20.5, 21.0]
+    assert stat.maximum == 21.0
+
+    # A reading back in range resets the count of rejected readings.
+    assert stat.add(21.0)
+    for _ in range(MAX_REJECTED - 1):
+        assert not stat.add(35.0)
+
+
+def test_outlier_sustained_jump_is_accepted():
+    stat = RollingStat(window=5, outlier_delta=3)
+    stat.add(20.0)
+
+    for _ in range(MAX_REJECTED - 1):
+        assert not stat.add(28.0)
+    assert stat.add(28.0)
+    assert stat.get_readings() == [20.0, 28.0]
+    assert stat.value == 24.0
@@ -0,0 +1,327 @@
+""" Tests for the rate limiter, circuit breaker and request scheduler.
+"""
+
+import asyncio
+
+import pytest
+
+import throttle
+from throttle import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_COMMAND,
+    PRIORITY_POLL,
+    CircuitBreaker,
+    RequestScheduler,
+    TokenBucket
+)
+
+
+class FakeClock:
+    """ Stand-in for time.monotonic that only moves when told to.
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeLimiter:
+    """ Limiter handing out a fixed number of tokens, then waiting forever.
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def try_acquire(self):
+        if self.tokens:
+            self.tokens -= 1
+            return 0.0
+        return 60.0
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(throttle.time, 'monotonic', fake)
+    return fake
+
+
+# ---------------------------------------------------------------
+
+def test_token_bucket_allows_burst_then_waits(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+
+    assert [bucket.try_acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.try_acquire() == pytest.approx(0.5)
+
+
+def test_token_bucket_refills_at_rate(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    for _ in range(3):
+        bucket.try_acquire()
+
+    clock.now += 0.5
+    assert bucket.try_acquire() == 0.0
+    assert bucket.try_acquire() == pytest.approx(0.5)
+
+
+def test_token_bucket_refill_capped_at_burst(clock):
+    bucket = TokenBucket(rate=2, burst=3)
+    clock.now += 3600
+
+    assert [bucket.try_acquire() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.try_acquire() > 0
+
+# ---------------------------------------------------------------
+
+def _open(breaker):
+    for _ in range(throttle.BREAKER_THRESHOLD):
+        breaker.record_failure()
+
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker()
+    for _ in range(throttle.BREAKER_THRESHOLD - 1):
+        breaker.record_failure()
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.is_open()
+    assert not breaker.allow()
+
+
+def test_breaker_success_resets_failures(clock):
+    breaker = CircuitBreaker()
+    for _ in range(throttle.BREAKER_THRESHOLD - 1):
+        breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert not breaker.is_open()
+
+
+def test_breaker_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(reset_seconds=60)
+    _open(breaker)
+    clock.now += 60
+
+    assert breaker.allow()
+    assert breaker.has_trial()
+    assert not breaker.allow()
+
+
+def test_breaker_trial_success_closes(clock):
+    breaker = CircuitBreaker(reset_seconds=60)
+    _open(breaker)
+    clock.now += 60
+    breaker.allow()
+
+    breaker.record_success()
+    assert not breaker.has_trial()
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_breaker_trial_failure_reopens(clock):
+    breaker = CircuitBreaker(reset_seconds=60)
+    _open(breaker)
+    clock.now += 60
+    breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.is_open()
+    assert not breaker.allow()
+
+    clock.now += 60
+    assert breaker.allow()
+
+
+def test_breaker_abandoned_trial_allows_another(clock):
+    breaker = CircuitBreaker(reset_seconds=60)
+    _open(breaker)
+    clock.now += 60
+    breaker.allow()
+
+    breaker.record_abandoned()
+    assert not breaker.has_trial()
+    assert breaker.allow()
+
+
+def test_breaker_abandon_after_result_is_harmless(clock):
+    breaker = CircuitBreaker(reset_seconds=60)
+    _open(breaker)
+    clock.now += 60
+    breaker.allow()
+    breaker.record_failure()
+
+    breaker.record_abandoned()
+    assert breaker.is_open()
+    assert not breaker.allow()
+
+# ---------------------------------------------------------------
+
+async def _hold(scheduler, order, name, priority=PRIORITY_POLL, key=None,
+                limited=True):
+    granted = await scheduler.async_acquire(priority, key, limited)
+    order.append((name, granted))
+    if granted:
+        await asyncio.sleep(0)
+        scheduler.release()
+
+
+async def _queue(scheduler, order, requests):
+    """ Take the only slot, queue the given requests behind it, then free
+        the slot and wait for all of them.
+    """
+    assert await scheduler.async_acquire()
+    tasks = []
+    for request in requests:
+        tasks.append(asyncio.ensure_future(_hold(scheduler, order, *request)))
+        await asyncio.sleep(0)
+    scheduler.release()
+    await asyncio.gather(*tasks)
+
+
+def test_scheduler_serves_by_priority_then_arrival():
+    async def _run():
+        scheduler = RequestScheduler(1)
+        order = []
+        await _queue(scheduler, order, [
+            ('background', PRIORITY_BACKGROUND),
+            ('poll 1', PRIORITY_POLL),
+            ('command', PRIORITY_COMMAND),
+            ('poll 2', PRIORITY_POLL)])
+        return order
+
+    assert asyncio.run(_run()) == [('command', True), ('poll 1', True),
+                                   ('poll 2', True), ('background', True)]
+
+
+def test_scheduler_bounds_requests_in_flight():
+    async def _run():
+        scheduler = RequestScheduler(2)
+        assert await scheduler.async_acquire()
+        assert await scheduler.async_acquire()
+
+        waiter = asyncio.ensure_future(scheduler.async_acquire())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+
+        scheduler.release()
+        return await waiter
+
+    assert asyncio.run(_run())
+
+
+def test_scheduler_command_drops_queued_polls_for_unit():
+    async def _run():
+        scheduler = RequestScheduler(1)
+        order = []
+        await _queue(scheduler, order, [
+            ('poll a', PRIORITY_POLL, 'a'),
+            ('poll b', PRIORITY_POLL, 'b'),
+            ('command a', PRIORITY_COMMAND, 'a')])
+        return order
+
+    assert asyncio.run(_run()) == [('poll a', False), ('command a', True),
+                                   ('poll b', True)]
+
+
+def test_scheduler_cancelled_waiter_frees_its_place():
+    async def _run():
+        scheduler = RequestScheduler(1)
+        assert await scheduler.async_acquire()
+
+        waiter = asyncio.ensure_future(scheduler.async_acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        scheduler.release()
+        return await asyncio.wait_for(scheduler.async_acquire(), 1)
+
+    assert asyncio.run(_run())
+
+
+def test_scheduler_cancel_after_grant_releases_slot():
+    async def _run():
+        scheduler = RequestScheduler(1)
+        assert await scheduler.async_acquire()
+
+        waiter = asyncio.ensure_future(scheduler.async_acquire())
+        await asyncio.sleep(0)
+        scheduler.release() # Grants the slot to the waiter...
+        waiter.cancel() # ...which goes away before using it.
+        await asyncio.gather(waiter, return_exceptions=True)
+
+        return await asyncio.wait_for(scheduler.async_acquire(), 1)
+
+    assert asyncio.run(_run())
+
+
+def test_scheduler_waits_for_tokens():
+    async def _run():
+        scheduler = RequestScheduler(4, FakeLimiter(1))
+        assert await scheduler.async_acquire()
+
+        waiter = asyncio.ensure_future(scheduler.async_acquire())
+        await asyncio.sleep(0)
+        done = waiter.done()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return done
+
+    assert not asyncio.run(_run())
+
+
+def test_scheduler_unlimited_passes_request_waiting_for_token():
+    async def _run():
+        scheduler = RequestScheduler(2, FakeLimiter(1))
+        assert await scheduler.async_acquire()
+
+        cloud = asyncio.ensure_future(scheduler.async_acquire())
+        await asyncio.sleep(0)
+        local = await asyncio.wait_for(
+            scheduler.async_acquire(PRIORITY_BACKGROUND, limited=False), 1)
+        done = cloud.done()
+        cloud.cancel()
+        await asyncio.gather(cloud, return_exceptions=True)
+        return local, done
+
+    assert asyncio.run(_run()) == (True, False)
+
+
+def test_scheduler_unlimited_bypass_keeps_slot_bound():
+    async def _run():
+        scheduler = RequestScheduler(2, FakeLimiter(1))
+        assert await scheduler.async_acquire()
+
+        cloud = asyncio.ensure_future(scheduler.async_acquire())
+        await asyncio.sleep(0)
+        assert await scheduler.async_acquire(limited=False)
+        local = asyncio.ensure_future(scheduler.async_acquire(limited=False))
+        await asyncio.sleep(0)
+        done = local.done()
+
+        scheduler.release()
+        granted = await asyncio.wait_for(local, 1)
+        cloud.cancel()
+        await asyncio.gather(cloud, return_exceptions=True)
+        return done, granted
+
+    assert asyncio.run(_run()) == (False, True)
+
+
+def test_scheduler_close_drops_queued_and_later_requests():
+    async def _run():
+        scheduler = RequestScheduler(1)
+        assert await scheduler.async_acquire()
+
+        waiter = asyncio.ensure_future(scheduler.async_acquire())
+        await asyncio.sleep(0)
+        scheduler.close()
+        return await waiter, await scheduler.async_acquire()
+
+    assert asyncio.run(_run()) == (False, False)
+
+# ---------------------------------------------------------------
@@ -0,0 +1,147 @@
+""" Tests for recording and replaying MelView traffic.
+"""
+
+import asyncio
+import json
+from http.cookies import SimpleCookie
+
+import aiohttp
+import pytest
+
+from transport import (
+    REDACTED,
+    CloudReply,
+    LocalReply,
+    MelViewRecorder,
+    MelViewReplayTransport
+)
+
+EMAIL = 'someone@example.com'
+PASSWORD = 'hunter2'
+COOKIE = 'secret-cookie-value'
+
+
+class FakeTransport:
+    """ Answers every cloud request with the given reply.
+    """
+    def __init__(self, reply):
+        self.reply = reply
+        self.cookies = {}
+
+    def set_cookie(self, name, value):
+        self.cookies[name] = value
+
+    def clear_cookies(self):
+        self.cookies = {}
+
+    async def async_post(self, endpoint, payload):
+        return self.reply
+
+    async def async_post_local(self, host, data):
+        return LocalReply(200, '<CSV></CSV>')
+
+    async def async_close(self):
+        pass
+
+
+def _login_reply():
+    cookies = SimpleCookie()
+    cookies['auth'] = COOKIE
+    cookies['auth']['max-age'] = 3600
+    return CloudReply(200, {'user': EMAIL, 'units': []}, cookies)
+
+
+def _record(path, reply, endpoint, payload):
+    async def _run():
+        recorder = MelViewRecorder(FakeTransport(reply), path)
+        recorder.set_cookie('auth', COOKIE)
+        await recorder.async_post(endpoint, payload)
+        await recorder.async_close()
+
+    asyncio.run(_run())
+    with open(path) as handle:
+        return handle.read()
+
+
+def test_recorder_redacts_credentials_and_cookies(tmp_path):
+    path = str(tmp_path / 'traffic.jsonl')
+    text = _record(path, _login_reply(), 'login.aspx',
+                   {'user': EMAIL, 'pass': PASSWORD, 'appversion': '1'})
+
+    assert EMAIL not in text
+    assert PASSWORD not in text
+    assert COOKIE not in text
+
+    record = json.loads(text)
+    assert record['payload'] == {'user': REDACTED, 'pass': REDACTED,
+                                 'appversion': '1'}
+    assert record['json']['user'] == REDACTED
+    assert record['cookies']['auth']['value'] == REDACTED
+    assert record['cookies']['auth']['max-age'] == 3600
+
+
+def test_recorder_redacts_nested_values(tmp_path):
+    path = str(tmp_path / 'traffic.jsonl')
+    reply = CloudReply(200, [{'units': [{'email': EMAIL,
+                                         'password': PASSWORD}]}],
+                       SimpleCookie())
+    text = _record(path, reply, 'rooms.aspx', {'unitid': 0})
+
+    assert EMAIL not in text
+    assert PASSWORD not in text
+
+# ---------------------------------------------------------------
+
+def _replay(tmp_path, records):
+    path = tmp_path / 'traffic.jsonl'
+    path.write_text(''.join(json.dumps(record) + '\n' for record in records))
+    return MelViewReplayTransport(str(path), speed=0)
+
+
+def _command(unitid, commands, status, json_reply):
+    payload = {'unitid': unitid}
+    if commands is not None:
+        payload['commands'] = commands
+    return {'kind': 'cloud', 'endpoint': 'unitcommand.aspx',
+            'payload': payload, 'status': status, 'json': json_reply,
+            'cookies': {}, 'time': 0, 'elapsed': 0}
+
+
+def test_replay_falls_back_from_commands_to_unit_to_endpoint(tmp_path):
+    replay = _replay(tmp_path, [
+        _command('1', 'PW1', 200, {'match': 'commands'}),
+        _command('2', None, 200, {'match': 'unit'})])
+
+    async def _run():
+        return [
+            (await replay.async_post('unitcommand.aspx',
+                                     {'unitid': '1', 'commands': 'PW1'})).json,
+            (await replay.async_post('unitcommand.aspx',
+                                     {'unitid': '2', 'commands': 'PW0'})).json,
+            (await replay.async_post('unitcommand.aspx',
+                                     {'unitid': '3'})).json]
+
+    # The unit-only fallback for unit 2 finds its poll; unit 3 has
+    # nothing recorded, so it gets the endpoint's first reply.
+    assert asyncio.run(_run()) == [{'match': 'commands'}, {'match': 'unit'},
+                                   {'match': 'commands'}]
+
+
+def test_replay_uses_replies_in_order_then_repeats_last(tmp_path):
+    replay = _replay(tmp_path, [
+        _command('1', None, 200, {'n': 1}),
+        _command('1', None, 200, {'n': 2})])
+
+    async def _run():
+        return [(await replay.async_post('unitcommand.aspx',
+                                         {'unitid': '1'})).json
+                for _ in range(3)]
+
+    assert asyncio.run(_run()) == [{'n': 1}, {'n': 2}, {'n': 2}]
+
+
+def test_replay_raises_for_unknown_endpoint(tmp_path):
+    replay = _replay(tmp_path, [_command('1', None, 200, {})])
+
+    with pytest.raises(aiohttp.ClientConnectionError):
+        asyncio.run(replay.async_post('rooms.aspx', {'unitid': 0}))
@@ -0,0 +1,273 @@
+#!/usr/local/bin/python3
+
+'''
+    Author: zacharyrs
+
+    How to install:
+        Refer to README.md
+
+    License:
+                DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+                        Version 2, December 2004
+
+        Everyone is permitted to copy and distribute verbatim or modified
+        copies of this license document, and changing it is allowed as long
+        as the name is changed.
+
+                  DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+          TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+
+         0. You just DO WHAT THE FUCK YOU WANT TO.
+'''
+
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_RATE = 2.0 # Requests per second.
+DEFAULT_BURST = 10
+
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 8.0
+
+BREAKER_THRESHOLD = 3 # Failed requests in a row before opening.
+BREAKER_RESET_SECONDS = 60
+
+DEFAULT_SLOTS = 8 # Requests in flight at once.
+
+# Request priorities, lowest served first.
+PRIORITY_COMMAND = 0
+PRIORITY_POLL = 1
+PRIORITY_BACKGROUND = 2
+
+
+# ---------------------------------------------------------------
+
+def backoff_delay(attempt, base=BACKOFF_BASE_SECONDS, cap=BACKOFF_MAX_SECONDS):
+    """ Exponential backoff with full jitter for the given retry attempt.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+# ---------------------------------------------------------------
+
+class TokenBucket:
+    """ Rate limiter allowing short bursts above the steady rate.
+    """
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._last_s = time.monotonic()
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._burst,
+                           self._tokens + (now - self._last_s) * self._rate)
+        self._last_s = now
+
+
+    def try_acquire(self):
+        """ Take a token if one is available. Returns 0, or the seconds
+            until the next token.
+        """
+        self._refill()
+        if self._tokens < 1:
+            return (1 - self._tokens) / self._rate
+        self._tokens -= 1
+        return 0.0
+
+# ---------------------------------------------------------------
+
+class CircuitBreaker:
+    """ Stops requests to a failing service for a while.
+        Once the reset time passes, a single trial request is let through;
+        its result closes the circuit or opens it again.
+    """
+    def __init__(self, threshold=BREAKER_THRESHOLD,
+                 reset_seconds=BREAKER_RESET_SECONDS):
+        self._threshold = threshold
+        self._reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_s = None
+        self._trial = False
+
+
+    def is_open(self):
+        """ Check whether requests are currently being stopped.
+        """
+        if self._opened_s is None:
+            return False
+
+        return (time.monotonic() - self._opened_s) < self._reset_seconds
+
+
+    def allow(self):
+        """ Check whether a request may be sent now.
+        """
+        if self._opened_s is None:
+            return True
+
+        if self.is_open() or self._trial:
+            return False
+
+        _LOGGER.debug('circuit half-open, sending trial request')
+        self._trial = True
+        return True
+
+
+    def has_trial(self):
+        """ Check whether a trial request is in flight.
+        """
+        return self._trial
+
+
+    def record_abandoned(self):
+        """ Record that the trial request ended without a result (e.g. it
+            was cancelled), so the next request may be tried instead.
+        """
+        if self._trial:
+            _LOGGER.debug('trial request abandoned')
+            self._trial = False
+
+
+    def record_success(self):
+        """ Record a request that got a reply.
+        """
+        if self._opened_s is not None:
+            _LOGGER.warning('melview api reachable again, closing circuit')
+        self._failures = 0
+        self._opened_s = None
+        self._trial = False
+
+
+    def record_failure(self):
+        """ Record a request that got no usable reply.
+        """
+        self._failures += 1
+        self._trial = False
+        if self._failures >= self._threshold:
+            if self._opened_s is None or not self.is_open():
+                _LOGGER.warning('melview api failing, pausing requests ' \
+                    'for %ds', self._reset_seconds)
+            self._opened_s = time.monotonic()
+
+# ---------------------------------------------------------------
+
+class RequestScheduler:
+    """ Bounds the requests in flight, handing free slots out by priority
+        (commands, then polls, then background work) and in order of
+        arrival within a priority. Rate limited requests also wait for a
+        token before taking a slot, so a command never queues behind polls
+        that are waiting on the limiter. Requests that skip the limiter
+        may take a free slot while the head of the queue waits for a token.
+        Queued polls for a unit are dropped when a command for the same
+        unit is queued, as its reply brings the unit's state anyway.
+    """
+    def __init__(self, slots=DEFAULT_SLOTS, limiter=None):
+        self._slots = slots
+        self._limiter = limiter
+        self._active = 0
+        self._queue = []
+        self._order = itertools.count()
+        self._timer = None
+        self._closed = False
+
+
+    async def async_acquire(self, priority=PRIORITY_POLL, key=None,
+                            limited=True):
+        """ Wait for a slot, and a token if limited. Returns False if the
+            request was dropped, otherwise release() must be called once
+            the request is done.
+        """
+        if self._closed:
+            return False
+
+        if priority == PRIORITY_COMMAND and key is not None:
+            self._drop(key)
+
+        result = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue,
+                       [priority, next(self._order), result, key, limited])
+        self._dispatch()
+
+        try:
+            return await result
+        except asyncio.CancelledError:
+            # Pass the slot on if it was granted as the caller went away.
+            if result.done() and not result.cancelled() and result.result():
+                self.release()
+            raise
+
+
+    def release(self):
+        """ Free the slot taken by async_acquire.
+        """
+        self._active -= 1
+        self._dispatch()
+
+
+    def close(self):
+        """ Drop all queued requests, and any made later.
+        """
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for entry in self._queue:
+            if not entry[2].done():
+                entry[2].set_result(False)
+        self._queue = []
+
+
+    def _drop(self, key):
+        for entry in self._queue:
+            if entry[3] == key and entry[0] > PRIORITY_COMMAND \
+                    and not entry[2].done():
+                _LOGGER.debug('dropping queued poll for %s', key)
+                entry[2].set_result(False)
+
+
+    def _wake(self):
+        self._timer = None
+        self._dispatch()
+
+
+    def _dispatch(self):
+        while self._queue and self._active < self._slots:
+            _, _, result, _, limited = self._queue[0]
+            if result.done():
+                heapq.heappop(self._queue)
+                continue
+
+            if limited and self._limiter is not None:
+                wait = self._limiter.try_acquire()
+                if wait:
+                    if self._timer is None:
+                        _LOGGER.debug('rate limited, waiting %.2fs', wait)
+                        self._timer = asyncio.get_running_loop().call_later(
+                            wait, self._wake)
+                    self._dispatch_unlimited()
+                    return
+
+            heapq.heappop(self._queue)
+            self._active += 1
+            result.set_result(True)
+
+
+    def _dispatch_unlimited(self):
+        # Requests that need no token go ahead of one waiting for a token.
+        # They stay in the heap as done entries until they reach the head.
+        for _, _, result, _, limited in sorted(self._queue):
+            if self._active >= self._slots:
+                return
+            if not limited and not result.done():
+                self._active += 1
+                result.set_result(True)
+
+# ---------------------------------------------------------------
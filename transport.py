@@ -0,0 +1,367 @@
+#!/usr/local/bin/python3
+
+'''
+    Author: zacharyrs
+
+    How to install:
+        Refer to README.md
+
+    License:
+                DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+                        Version 2, December 2004
+
+        Everyone is permitted to copy and distribute verbatim or modified
+        copies of this license document, and changing it is allowed as long
+        as the name is changed.
+
+                  DO WHAT THE FUCK YOU WANT TO PUBLIC LICENSE
+          TERMS AND CONDITIONS FOR COPYING, DISTRIBUTION AND MODIFICATION
+
+         0. You just DO WHAT THE FUCK YOU WANT TO.
+'''
+
+import asyncio
+import ipaddress
+import json
+import logging
+import time
+from collections import Counter, namedtuple
+from http.cookies import SimpleCookie
+
+import aiohttp
+from yarl import URL
+
+_LOGGER = logging.getLogger(__name__)
+
+API_URL = 'https://api.melview.net/api/{}'
+DEFAULT_POOL_SIZE = 8
+KEEPALIVE_SECONDS = 90 # Outlive the polling interval.
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) ' \
+    'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.131 Safari/537.36'}
+
+CLOUD_CONNECT_SECONDS = 5
+CLOUD_READ_SECONDS = 10
+LOCAL_CONNECT_SECONDS = 1
+LOCAL_READ_SECONDS = 2
+
+REDACTED = '<redacted>'
+REDACTED_KEYS = ('user', 'pass', 'email', 'username', 'password')
+RECORD_FLUSH_COUNT = 100 # Exchanges buffered before writing to disk.
+
+CloudReply = namedtuple('CloudReply', ['status', 'json', 'cookies'])
+LocalReply = namedtuple('LocalReply', ['status', 'text'])
+
+
+# ---------------------------------------------------------------
+
+def request_timeout(connect, read):
+    """ Build a request timeout from connect and read deadlines, in
+        seconds. The whole request is bounded by their sum.
+    """
+    return aiohttp.ClientTimeout(total=connect + read, sock_connect=connect,
+                                 sock_read=read)
+
+
+def _is_ip(host):
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return True
+
+
+def _redact(value):
+    if isinstance(value, dict):
+        return {key: REDACTED if key in REDACTED_KEYS else _redact(val)
+                for key, val in value.items()}
+    if isinstance(value, list):
+        return [_redact(val) for val in value]
+    return value
+
+# ---------------------------------------------------------------
+
+class MelViewTransport:
+    """ Sends cloud and LAN requests over a shared aiohttp session.
+        Errors are raised as aiohttp.ClientError or asyncio.TimeoutError.
+    """
+    def __init__(self, api_url=API_URL, session=None,
+                 pool_size=DEFAULT_POOL_SIZE, cloud_timeout=None,
+                 local_timeout=None):
+        self._api_url = api_url
+        self._api_root = URL(api_url.format(''))
+        self._session = session
+        self._owns_session = session is None
+        self._pool_size = pool_size
+        self._cookies = {}
+        self._cloud_timeout = cloud_timeout or request_timeout(
+            CLOUD_CONNECT_SECONDS, CLOUD_READ_SECONDS)
+        self._local_timeout = local_timeout or request_timeout(
+            LOCAL_CONNECT_SECONDS, LOCAL_READ_SECONDS)
+
+
+    def get_session(self):
+        """ Return the HTTP session, creating one if needed.
+            The session keeps connections alive between polls and holds
+            the auth cookie in its cookie jar.
+            Must be called from within the event loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._pool_size, keepalive_timeout=KEEPALIVE_SECONDS)
+            # Cookies from IP hosts are only accepted when asked to.
+            jar = aiohttp.CookieJar(unsafe=_is_ip(self._api_root.host))
+            self._session = aiohttp.ClientSession(
+                connector=connector, cookie_jar=jar, headers=HEADERS,
+                timeout=self._cloud_timeout)
+            self._owns_session = True
+            if self._cookies:
+                self._session.cookie_jar.update_cookies(self._cookies,
+                                                        self._api_root)
+        return self._session
+
+
+    def set_cookie(self, name, value):
+        """ Send a cookie with every cloud request.
+        """
+        self._cookies[name] = value
+        self.get_session().cookie_jar.update_cookies({name: value},
+                                                     self._api_root)
+
+
+    def clear_cookies(self):
+        """ Forget all cloud cookies.
+        """
+        self._cookies = {}
+        self.get_session().cookie_jar.clear_domain(self._api_root.host)
+
+
+    async def async_post(self, endpoint, payload):
+        """ POST to a cloud API endpoint. Returns a CloudReply.
+        """
+        async with self.get_session().post(
+                self._api_url.format(endpoint), json=payload,
+                headers=HEADERS, timeout=self._cloud_timeout) as req:
+            reply = CloudReply(req.status, None, req.cookies)
+            if req.status == 200:
+                reply = reply._replace(json=await req.json(content_type=None))
+            return reply
+
+
+    async def async_post_local(self, host, data):
+        """ POST to a unit's /smart endpoint. Returns a LocalReply.
+        """
+        async with self.get_session().post(
+                'http://{}/smart'.format(host), data=data,
+                timeout=self._local_timeout) as req:
+            text = await req.text() if req.status == 200 else None
+            return LocalReply(req.status, text)
+
+
+    async def async_close(self):
+        """ Close the HTTP session, if it was created here.
+        """
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+# ---------------------------------------------------------------
+
+class MelViewRecorder:
+    """ Wraps a transport, appending each exchange to a JSON lines file
+        with credentials and cookie values redacted.
+    """
+    def __init__(self, transport, path):
+        self._transport = transport
+        self._path = path
+        self._start = time.monotonic()
+        self._pending = []
+
+
+    def set_cookie(self, name, value):
+        """ Send a cookie with every cloud request.
+        """
+        self._transport.set_cookie(name, value)
+
+
+    def clear_cookies(self):
+        """ Forget all cloud cookies.
+        """
+        self._transport.clear_cookies()
+
+
+    async def async_post(self, endpoint, payload):
+        """ POST to a cloud API endpoint, recording the exchange.
+        """
+        def _describe(reply):
+            return {'status': reply.status, 'json': _redact(reply.json),
+                    'cookies': {name: {'value': REDACTED,
+                                       'max-age': morsel['max-age'],
+                                       'expires': morsel['expires']}
+                                for name, morsel in reply.cookies.items()}}
+
+        return await self._async_record(
+            {'kind': 'cloud', 'endpoint': endpoint,
+             'payload': _redact(payload)},
+            self._transport.async_post(endpoint, payload), _describe)
+
+
+    async def async_post_local(self, host, data):
+        """ POST to a unit's /smart endpoint, recording the exchange.
+        """
+        def _describe(reply):
+            return {'status': reply.status, 'text': reply.text}
+
+        return await self._async_record(
+            {'kind': 'local', 'host': host, 'data': data},
+            self._transport.async_post_local(host, data), _describe)
+
+
+    async def _async_record(self, record, coro, describe):
+        record['time'] = round(time.monotonic() - self._start, 3)
+        try:
+            reply = await coro
+            record.update(describe(reply))
+        except asyncio.TimeoutError:
+            record['error'] = 'timeout'
+            raise
+        except asyncio.CancelledError:
+            record['error'] = 'cancelled'
+            raise
+        except aiohttp.ClientError as err:
+            record['error'] = repr(err)
+            raise
+        finally:
+            record['elapsed'] = round(time.monotonic() - self._start -
+                                      record['time'], 3)
+            self._pending.append(record)
+            if len(self._pending) >= RECORD_FLUSH_COUNT:
+                await self.async_flush()
+        return reply
+
+
+    async def async_flush(self):
+        """ Append the buffered exchanges to the file.
+        """
+        pending, self._pending = self._pending, []
+        if pending:
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._write, pending)
+
+
+    def _write(self, records):
+        with open(self._path, 'a') as handle:
+            for record in records:
+                handle.write(json.dumps(record) + '\n')
+
+
+    async def async_close(self):
+        """ Write any buffered exchanges and close the wrapped transport.
+        """
+        await self.async_flush()
+        await self._transport.async_close()
+
+# ---------------------------------------------------------------
+
+class MelViewReplayTransport:
+    """ Serves the exchanges in a file written by MelViewRecorder.
+        Requests are matched on endpoint, unit and commands, falling back
+        to the same unit and then the same endpoint. Each recorded reply is
+        used once in order, except the last for a match, which repeats.
+        Recorded latencies are divided by speed (0 for no delay).
+    """
+    def __init__(self, path, speed=1.0):
+        self._speed = speed
+        self._replies = {}
+        self.requests = Counter()
+
+        with open(path) as handle:
+            for line in handle:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                for key in self._keys(record):
+                    self._replies.setdefault(key, []).append(record)
+        _LOGGER.debug('loaded %d replay keys from %s', len(self._replies),
+                      path)
+
+
+    @staticmethod
+    def _keys(record):
+        if record['kind'] == 'local':
+            status = '<CODE>' not in record['data']
+            return [('local', record['host'], status), ('local', status)]
+
+        payload = record['payload']
+        return [(record['endpoint'], payload.get('unitid'),
+                 payload.get('commands')),
+                (record['endpoint'], payload.get('unitid')),
+                (record['endpoint'],)]
+
+
+    def reset_counts(self):
+        """ Clear the per-endpoint request counters.
+        """
+        self.requests.clear()
+
+
+    def set_cookie(self, name, value):
+        """ Cookies are not checked on replay.
+        """
+
+
+    def clear_cookies(self):
+        """ Cookies are not checked on replay.
+        """
+
+
+    async def _async_replay(self, keys):
+        for key in keys:
+            replies = self._replies.get(key)
+            if replies:
+                break
+        else:
+            raise aiohttp.ClientConnectionError(
+                'no recorded reply for {}'.format(keys[0]))
+
+        record = replies.pop(0) if len(replies) > 1 else replies[0]
+        if self._speed:
+            await asyncio.sleep(record['elapsed'] / self._speed)
+        if record.get('error') == 'timeout':
+            raise asyncio.TimeoutError()
+        # Exchanges cut short (e.g. cancelled) have no reply to serve.
+        if 'error' in record or 'status' not in record:
+            raise aiohttp.ClientConnectionError(
+                record.get('error', 'no reply recorded'))
+        return record
+
+
+    async def async_post(self, endpoint, payload):
+        """ Serve a recorded cloud reply.
+        """
+        self.requests[endpoint] += 1
+        record = await self._async_replay(self._keys(
+            {'kind': 'cloud', 'endpoint': endpoint, 'payload': payload}))
+
+        cookies = SimpleCookie()
+        for name, attrs in record.get('cookies', {}).items():
+            cookies[name] = 'replay'
+            for attr in ('max-age', 'expires'):
+                if attrs.get(attr):
+                    cookies[name][attr] = attrs[attr]
+        return CloudReply(record['status'], record.get('json'), cookies)
+
+
+    async def async_post_local(self, host, data):
+        """ Serve a recorded reply from a unit.
+        """
+        self.requests['smart'] += 1
+        record = await self._async_replay(self._keys(
+            {'kind': 'local', 'host': host, 'data': data}))
+        return LocalReply(record['status'], record.get('text'))
+
+
+    async def async_close(self):
+        """ Nothing to close on replay.
+        """
+
+# ---------------------------------------------------------------